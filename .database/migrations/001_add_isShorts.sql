@@ -0,0 +1,3 @@
+-- Shorts判定結果をキャッシュする (NULL: 未判定)
+ALTER TABLE TargetVideo ADD COLUMN isShorts TINYINT(1) NULL DEFAULT NULL;
+UPDATE TargetVideo SET isShorts = 1 WHERE videoType = 'shorts';
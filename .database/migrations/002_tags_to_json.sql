@@ -0,0 +1,10 @@
+-- tags をJSONカラムに変更する
+-- 旧形式 (['a','b']) の行が残っているとエラーになるため、先にJSON (["a","b"]) に書き換える
+-- 旧形式はタグを ',' でつないだだけなので、区切りを "," に置き換え、タグ内の \ と " はエスケープする
+-- (JSON形式の行は [" で始まるので対象外。何度実行しても同じ結果になる)
+UPDATE TargetVideo
+SET tags = CONCAT('["',
+                  REPLACE(REPLACE(REPLACE(SUBSTRING(tags, 3, CHAR_LENGTH(tags) - 4), '\\', '\\\\'), '"', '\\"'), "','", '","'),
+                  '"]')
+WHERE tags LIKE '[''%'']';
+ALTER TABLE TargetVideo MODIFY tags JSON NULL;
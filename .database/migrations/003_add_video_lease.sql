@@ -0,0 +1,6 @@
+-- 複数ワーカーで処理するための動画ごとのリース
+ALTER TABLE TargetVideo
+    ADD COLUMN leaseOwner VARCHAR(64) NULL DEFAULT NULL,
+    ADD COLUMN leaseExpiresAt DATETIME NULL DEFAULT NULL,
+    ADD INDEX idx_TargetVideo_queue (isPushed, isDownloaded, publishedAt),
+    ADD INDEX idx_TargetVideo_leaseOwner (leaseOwner);
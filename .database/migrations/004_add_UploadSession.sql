@@ -0,0 +1,9 @@
+-- 中断したアップロードを再開するためのセッション情報
+CREATE TABLE UploadSession (
+    videoId VARCHAR(32) NOT NULL PRIMARY KEY,
+    uploaderName VARCHAR(64) NOT NULL,
+    sessionUri TEXT NOT NULL,
+    progress BIGINT NOT NULL DEFAULT 0,
+    fileSize BIGINT NOT NULL,
+    updatedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
@@ -0,0 +1,3 @@
+-- 最後にアップロード・更新したタイトル・説明文・タグのハッシュ (取得日時は除く)
+-- edit_video.py --batch で変更があった動画だけを更新するために使う
+ALTER TABLE TargetVideo ADD COLUMN pushedHash CHAR(64) NULL DEFAULT NULL;
@@ -0,0 +1,12 @@
+-- 統計情報以外のカラムのハッシュ (同期時に変更がない行は書き込まない)
+ALTER TABLE TargetVideo ADD COLUMN contentHash CHAR(64) NULL DEFAULT NULL;
+
+-- 同期ごとに変化があった統計情報の履歴
+CREATE TABLE VideoStatisticsHistory (
+    videoId VARCHAR(32) NOT NULL,
+    recordedAt DATETIME NOT NULL,
+    viewCount BIGINT NULL,
+    likeCount BIGINT NULL,
+    commentCount BIGINT NULL,
+    PRIMARY KEY (videoId, recordedAt)
+);
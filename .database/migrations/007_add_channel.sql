@@ -0,0 +1,8 @@
+-- 複数のチャンネルをアーカイブするための取得元チャンネル
+-- 既存の行は、次回起動時の最初の同期で TARGET_YOUTUBE_CHANNEL_ID の最初のチャンネルとして埋められる
+-- (チャンネルIDは .env の設定なので、ここでは埋めない) 手動で埋める場合は以下を実行する
+--   UPDATE TargetVideo SET channelId = '<最初のチャンネルID>', channelTitle = '<チャンネル名>' WHERE channelId IS NULL;
+ALTER TABLE TargetVideo
+    ADD COLUMN channelId VARCHAR(32) NULL DEFAULT NULL,
+    ADD COLUMN channelTitle TEXT NULL,
+    ADD INDEX idx_TargetVideo_channel_queue (channelId, isPushed, isDownloaded, publishedAt);
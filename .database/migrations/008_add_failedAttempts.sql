@@ -0,0 +1,7 @@
+-- ダウンロード・アップロードに失敗した回数と次に再試行できる日時
+-- 失敗し続ける動画 (非公開・削除済み・メンバー限定など) で処理が止まらないようにする
+-- 上限に達した動画を再試行する場合は failedAttempts = 0 に戻す
+ALTER TABLE TargetVideo
+    ADD COLUMN failedAttempts INT NOT NULL DEFAULT 0,
+    ADD COLUMN nextAttemptAt DATETIME NULL DEFAULT NULL,
+    ADD COLUMN lastError TEXT NULL;
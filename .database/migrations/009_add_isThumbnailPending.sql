@@ -0,0 +1,3 @@
+-- アップロード後にサムネイルの設定が終わっていない動画 (1: 未設定)
+-- 動画は送り直さず、次の処理でサムネイルだけを設定し直す
+ALTER TABLE TargetVideo ADD COLUMN isThumbnailPending TINYINT(1) NOT NULL DEFAULT 0;
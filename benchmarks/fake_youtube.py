@@ -0,0 +1,215 @@
+import json
+import time
+import uuid
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+UPLOADS_PLAYLIST_ID = "UUbenchmark"
+
+
+def video_id_of(index: int) -> str:
+    # YouTube と同じ11文字のID
+    return f"bench{index:06d}"
+
+
+def make_video_item(index: int, part: str) -> dict:
+    # 10本に1本が Shorts、5本に1本がライブ配信アーカイブの合成データ
+    parts = part.split(",")
+    item = {"kind": "youtube#video", "etag": f"etag{index}", "id": video_id_of(index)}
+    if "snippet" in parts:
+        item["snippet"] = {
+            "publishedAt": f"2023-{index % 12 + 1:02d}-{index % 28 + 1:02d}T{index % 24:02d}:00:00Z",
+            "channelId": "UCbenchmark",
+            "title": f"ベンチマーク動画 #{index}",
+            "description": f"ベンチマーク用の説明文です。\n{'あいうえお' * (index % 50)}",
+            "thumbnails": {size: {"url": f"https://i.ytimg.com/vi/{video_id_of(index)}/{size}.jpg", "width": 1280, "height": 720}
+                           for size in ("default", "medium", "high", "standard", "maxres")},
+            "channelTitle": "Benchmark Ch.",
+            "tags": [f"tag{index % 7}", "ベンチマーク"],
+            "categoryId": "22",
+            "liveBroadcastContent": "none",
+            "localized": {"title": f"ベンチマーク動画 #{index}", "description": "ベンチマーク用の説明文です。"}
+        }
+    if "statistics" in parts:
+        item["statistics"] = {
+            "viewCount": str(index * 31 + 1000),
+            "likeCount": str(index * 3 + 10),
+            "favoriteCount": "0",
+            "commentCount": str(index % 300)
+        }
+    if "liveStreamingDetails" in parts and index % 5 == 1:
+        item["liveStreamingDetails"] = {
+            "scheduledStartTime": "2023-01-01T12:00:00Z",
+            "actualStartTime": "2023-01-01T12:01:00Z",
+            "actualEndTime": "2023-01-01T14:00:00Z"
+        }
+    if "localizations" in parts:
+        item["localizations"] = {lang: {"title": f"Benchmark video #{index}", "description": "x" * 500}
+                                 for lang in ("en", "ko", "zh-TW", "es")}
+    return item
+
+
+def is_shorts(index: int) -> bool:
+    return index % 10 == 0
+
+
+class FakeYoutubeServer:
+    def __init__(self, video_count: int = 1000, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        # YouTube Data API (channels / playlistItems / videos / 再開可能アップロード) と
+        # Shorts 判定用の /shorts/<id> を返すローカルサーバー
+        self.video_count = video_count
+        # 1リクエストごとの疑似的な遅延 (秒)
+        self.latency = latency
+        self.uploads = {}
+        self.stats = defaultdict(lambda: {"requests": 0, "bytes": 0})
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+    def start(self) -> "FakeYoutubeServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="FakeYoutubeServer", daemon=True)
+        self._thread.start()
+        return self
+
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.stats.clear()
+
+
+    def _record(self, endpoint: str, size: int) -> None:
+        with self._lock:
+            self.stats[endpoint]["requests"] += 1
+            self.stats[endpoint]["bytes"] += size
+
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: dict = None, headers: dict = None, endpoint: str = None):
+                data = json.dumps(body).encode("utf-8") if body is not None else b""
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                if body is not None:
+                    self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(data)
+                server._record(endpoint or urlparse(self.path).path, len(data))
+
+            def _read_body(self) -> bytes:
+                length = int(self.headers.get("Content-Length", 0))
+                return self.rfile.read(length) if length else b""
+
+            def _delay(self):
+                if server.latency:
+                    time.sleep(server.latency)
+
+            def do_HEAD(self):
+                self._delay()
+                path = urlparse(self.path).path
+                if path.startswith("/shorts/"):
+                    video_id = path[len("/shorts/"):]
+                    index = int(video_id[len("bench"):]) if video_id.startswith("bench") else -1
+                    if index >= 0 and is_shorts(index):
+                        self._send(200, endpoint="/shorts")
+                    else:
+                        self._send(303, headers={"Location": f"{server.url}/watch?v={video_id}"}, endpoint="/shorts")
+                else:
+                    self._send(404)
+
+            def do_GET(self):
+                self._delay()
+                parsed = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+                if parsed.path == "/youtube/v3/channels":
+                    self._send(200, {"items": [{"snippet": {"title": "Benchmark Ch."},
+                                                "contentDetails": {"relatedPlaylists": {"uploads": UPLOADS_PLAYLIST_ID}}}]})
+                elif parsed.path == "/youtube/v3/playlistItems":
+                    # アップロード再生リストと同じく新しい順に返す
+                    offset = int(query.get("pageToken", 0))
+                    limit = int(query.get("maxResults", 5))
+                    end = min(offset + limit, server.video_count)
+                    items = [{"snippet": {"resourceId": {"videoId": video_id_of(server.video_count - 1 - i)}}}
+                             for i in range(offset, end)]
+                    body = {"items": items}
+                    if end < server.video_count:
+                        body["nextPageToken"] = str(end)
+                    self._send(200, body)
+                elif parsed.path == "/youtube/v3/videos":
+                    ids = query.get("id", "").split(",")
+                    indexes = [int(video_id[len("bench"):]) for video_id in ids if video_id.startswith("bench")]
+                    part = query.get("part", "snippet")
+                    self._send(200, {"items": [make_video_item(index, part) for index in indexes if index < server.video_count]})
+                else:
+                    self._send(404, {"error": {"code": 404, "message": "Not Found"}})
+
+            def do_POST(self):
+                self._delay()
+                parsed = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+                body = self._read_body()
+                if parsed.path in ("/upload/youtube/v3/videos", "/upload/youtube/v3/thumbnails/set") and query.get("uploadType") == "resumable":
+                    session_id = uuid.uuid4().hex
+                    with server._lock:
+                        server.uploads[session_id] = {
+                            "kind": "thumbnail" if parsed.path.endswith("/set") else "video",
+                            "videoId": query.get("videoId"),
+                            "metadata": json.loads(body) if body else {},
+                            "received": 0
+                        }
+                    self._send(200, headers={"Location": f"{server.url}/upload/session/{session_id}"})
+                else:
+                    self._send(404, {"error": {"code": 404, "message": "Not Found"}})
+
+            def do_PUT(self):
+                self._delay()
+                parsed = urlparse(self.path)
+                session_id = parsed.path.rsplit("/", 1)[-1]
+                session = server.uploads.get(session_id)
+                body = self._read_body()
+                if not parsed.path.startswith("/upload/session/") or session is None:
+                    self._send(404, {"error": {"code": 404, "message": "Upload session not found"}})
+                    return
+
+                # Content-Range: bytes 0-1023/4096 または bytes */4096 (受信済みサイズの問い合わせ)
+                content_range = self.headers.get("Content-Range", "")
+                total = content_range.rsplit("/", 1)[-1]
+                if not content_range.startswith("bytes */"):
+                    session["received"] += len(body)
+                if total != "*" and session["received"] >= int(total):
+                    if session["kind"] == "thumbnail":
+                        response = {"kind": "youtube#thumbnailSetResponse", "items": [{}]}
+                    else:
+                        response = {"kind": "youtube#video", "id": f"up{session_id[:9]}",
+                                    "snippet": session["metadata"].get("snippet", {})}
+                    self._send(200, response, endpoint=f"/upload/{session['kind']}")
+                else:
+                    headers = {"Range": f"bytes=0-{session['received'] - 1}"} if session["received"] else {}
+                    self._send(308, headers=headers, endpoint=f"/upload/{session['kind']}")
+
+        return Handler
@@ -0,0 +1,265 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime
+
+from dotenv import dotenv_values, find_dotenv
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+# .database/docker-compose.yml のローカルMySQLを使う (本番のデータベースには接続しない)
+BENCH_DB = {
+    "db_user": os.getenv("BENCH_DB_USER", "root"),
+    "db_password": os.getenv("BENCH_DB_PASSWORD", "root_psw"),
+    "db_host": os.getenv("BENCH_DB_HOST", "127.0.0.1"),
+    "db_port": os.getenv("BENCH_DB_PORT", "12345"),
+    "db_database": os.getenv("BENCH_DB_DATABASE", "YoutubeArchiverBench")
+}
+
+
+def configure_database() -> None:
+    # modules.youtube_uploader は import 時に DB_* から接続するので、先に環境変数を差し替える
+    production = dotenv_values(find_dotenv()).get("DB_DATABASE")
+    if BENCH_DB["db_database"] == production:
+        raise SystemExit(f"BENCH_DB_DATABASE must not be the production database: {production}")
+    os.environ.update({
+        "DB_USER": BENCH_DB["db_user"],
+        "DB_PASSWORD": BENCH_DB["db_password"],
+        "DB_HOST": BENCH_DB["db_host"],
+        "DB_PORT": BENCH_DB["db_port"],
+        "DB_DATABASE": BENCH_DB["db_database"]
+    })
+
+
+configure_database()
+sys.path.insert(0, ROOT_DIR)
+
+import pandas as pd
+from google.auth.credentials import AnonymousCredentials
+
+from modules.db import DBManager
+from modules import youtube_uploader
+from modules.youtube_uploader import YoutubeVideoManager, TARGET_VIDEO_COLUMNS, into_str, content_hash
+from modules.description import format_video_info, format_video_info_batch
+from benchmarks.fake_youtube import FakeYoutubeServer, make_video_item
+
+
+db = youtube_uploader.db
+
+
+def reset_database() -> None:
+    server_db = DBManager(**dict(BENCH_DB, db_database="mysql"))
+    server_db.run(server_db.query(
+        f"CREATE DATABASE IF NOT EXISTS {BENCH_DB['db_database']} CHARACTER SET utf8mb4 COLLATE utf8mb4_bin;"))
+    server_db.run(server_db.engine.dispose())
+
+    with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+        lines = [line for line in f.read().splitlines() if not line.startswith("--")]
+    for statement in "\n".join(lines).split(";"):
+        if statement.strip():
+            db.run(db.query(statement))
+    for name in ("YoutubeArchiver", "default-01", "default-02"):
+        db.run(db.query("INSERT INTO QuotaData (name, identityFile, quota) VALUES (:name, 'benchmark.json', 0);",
+                        {"name": name}))
+
+
+def make_manager(server: FakeYoutubeServer, args) -> YoutubeVideoManager:
+    return YoutubeVideoManager(
+        api_key="benchmark",
+        target_channel_id="UCbenchmark",
+        upload_channel_id="UCbenchmarkUpload",
+        max_threads=args.threads,
+        fetch_threads=args.fetch_threads,
+        upload_chunk_size=args.chunk_mb * 1024 * 1024,
+        api_endpoint=server.url,
+        youtube_url=server.url,
+        credentials=AnonymousCredentials()
+    )
+
+
+@contextlib.contextmanager
+def quiet(verbose: bool):
+    # 計測中の進捗表示を抑える
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def result(name: str, size: int, elapsed: float, count: float, unit: str, **extra) -> dict:
+    return dict({"benchmark": name, "size": size, "seconds": round(elapsed, 3),
+                 "rate": round(count / elapsed, 1) if elapsed else None, "unit": unit}, **extra)
+
+
+def bench_sync(size: int, args) -> list[dict]:
+    reset_database()
+    server = FakeYoutubeServer(size, latency=args.latency).start()
+    try:
+        with quiet(args.verbose):
+            manager = make_manager(server, args)
+            start = time.perf_counter()
+            manager.save_video_data()
+            first = time.perf_counter() - start
+            bytes_first = sum(stat["bytes"] for stat in server.stats.values())
+
+            server.reset_stats()
+            start = time.perf_counter()
+            manager.save_video_data()
+            second = time.perf_counter() - start
+            bytes_second = sum(stat["bytes"] for stat in server.stats.values())
+            manager.quota_ledger.close()
+    finally:
+        server.stop()
+    return [result("sync (initial)", size, first, size, "videos/s", response_bytes=bytes_first),
+            result("sync (incremental)", size, second, size, "videos/s", response_bytes=bytes_second)]
+
+
+def bench_upsert(size: int, args) -> list[dict]:
+    reset_database()
+    part = "snippet,statistics,liveStreamingDetails"
+    rows = [dict(zip(TARGET_VIDEO_COLUMNS, into_str(make_video_item(i, part)))) for i in range(size)]
+    results = []
+    for name in ("upsert (insert)", "upsert (unchanged)"):
+        start = time.perf_counter()
+        db.run(db.bulk_upsert("TargetVideo", TARGET_VIDEO_COLUMNS, rows, batch_size=args.db_batch_size))
+        results.append(result(name, size, time.perf_counter() - start, size, "rows/s"))
+
+    # contentHash が一致する行は送らない (同期時と同じ書き込み方)
+    for row in rows:
+        row["contentHash"] = content_hash(row)
+    for name in ("upsert hashed (first)", "upsert hashed (unchanged)"):
+        start = time.perf_counter()
+        db.run(db.bulk_upsert("TargetVideo", TARGET_VIDEO_COLUMNS + ["contentHash"], rows,
+                              batch_size=args.db_batch_size, hash_column="contentHash"))
+        results.append(result(name, size, time.perf_counter() - start, size, "rows/s"))
+    return results
+
+
+def bench_format_response(size: int, args) -> list[dict]:
+    data = pd.DataFrame({
+        "id": [f"bench{i:06d}" for i in range(size)],
+        "title": [f"ベンチマーク動画 #{i}" for i in range(size)],
+        "tags": [json.dumps([f"tag{i % 7}", "ベンチマーク"], ensure_ascii=False) for i in range(size)]
+    })
+    start = time.perf_counter()
+    db.run(db._format_response(data))
+    return [result("_format_response", size, time.perf_counter() - start, size, "rows/s")]
+
+
+def bench_description(size: int, args) -> list[dict]:
+    # bench_upsert で書き込んだ行を使う
+    videos = db.run(db.query(f"SELECT * FROM TargetVideo ORDER BY publishedAt ASC LIMIT {int(size)};"))
+    records = videos.to_dict("records")
+    fetched_at = datetime.now()
+    start = time.perf_counter()
+    for video in records:
+        format_video_info(video, fetched_at)
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    format_video_info_batch(videos, fetched_at)
+    batch = time.perf_counter() - start
+    return [result("description (per row)", len(records), single, len(records), "videos/s"),
+            result("description (batch)", len(records), batch, len(records), "videos/s")]
+
+
+def bench_upload(size: int, args) -> list[dict]:
+    reset_database()
+    work_dir = tempfile.mkdtemp(prefix="upload-", dir=".")
+    file_size = args.upload_mb * 1024 * 1024
+    paths = []
+    for i in range(args.upload_files):
+        path = os.path.join(work_dir, f"bench{i:06d}.mp4")
+        with open(path, "wb") as f:
+            f.write(os.urandom(file_size))
+        paths.append(path)
+    thumbnail_path = os.path.join(work_dir, "thumbnail.jpg")
+    with open(thumbnail_path, "wb") as f:
+        f.write(os.urandom(64 * 1024))
+
+    server = FakeYoutubeServer(0, latency=args.latency).start()
+    try:
+        with quiet(args.verbose):
+            manager = make_manager(server, args)
+            dispatcher = manager.start_dispatcher(args.upload_concurrency)
+            start = time.perf_counter()
+            futures = [dispatcher.submit(
+                lambda uploader_name, path=path: manager.upload_video(
+                    path, "ベンチマーク", "ベンチマーク用の説明文です。", "22", thumbnail_path, ["ベンチマーク"],
+                    uploader_name=uploader_name, video_id=os.path.basename(path).split(".")[0]))
+                for path in paths]
+            for future in futures:
+                future.result()
+            elapsed = time.perf_counter() - start
+            dispatcher.shutdown()
+            manager.quota_ledger.close()
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir)
+    return [result("upload pipeline", len(paths), elapsed, len(paths) * args.upload_mb, "MB/s",
+                   concurrency=args.upload_concurrency)]
+
+
+BENCHMARKS = {
+    "sync": bench_sync,
+    "upsert": bench_upsert,
+    "format_response": bench_format_response,
+    "description": bench_description,
+    "upload": bench_upload
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="YoutubeArchiver offline benchmarks")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="合成チャンネルの動画数 (カンマ区切り)")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="実行するベンチマーク (カンマ区切り)")
+    parser.add_argument("--latency", type=float, default=0.0, help="ローカルAPIサーバーの1リクエストあたりの遅延 (秒)")
+    parser.add_argument("--threads", type=int, default=20, help="Shorts判定の並列数")
+    parser.add_argument("--fetch-threads", type=int, default=4, help="動画データ取得の並列数")
+    parser.add_argument("--db-batch-size", type=int, default=500)
+    parser.add_argument("--chunk-mb", type=int, default=1, help="アップロードのチャンクサイズ (MB)")
+    parser.add_argument("--upload-files", type=int, default=8)
+    parser.add_argument("--upload-mb", type=int, default=16)
+    parser.add_argument("--upload-concurrency", type=int, default=2)
+    parser.add_argument("--output", help="結果をJSON Linesで追記するファイル")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    names = args.only.split(",")
+
+    # スナップショットなどの出力は一時ディレクトリに書き込む
+    work_dir = tempfile.mkdtemp(prefix="youtube-archiver-bench-")
+    os.chdir(work_dir)
+    results = []
+    try:
+        for name in names:
+            # アップロードは動画数に依存しないので1回だけ計測する
+            for size in (sizes[:1] if name == "upload" else sizes):
+                if name == "description":
+                    # 説明文の元になる行を用意する
+                    bench_upsert(size, args)
+                for item in BENCHMARKS[name](size, args):
+                    print(f"{item['benchmark']:<24} size={item['size']:<8} {item['seconds']:>9.3f} sec  {item['rate']:>12} {item['unit']}")
+                    results.append(item)
+    finally:
+        os.chdir(ROOT_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            for item in results:
+                f.write(json.dumps(dict(item, timestamp=datetime.now().isoformat()), ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
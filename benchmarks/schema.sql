@@ -0,0 +1,63 @@
+-- ベンチマーク用のテーブル定義 (.database/migrations 適用後と同じ構成)
+DROP TABLE IF EXISTS TargetVideo;
+DROP TABLE IF EXISTS QuotaData;
+DROP TABLE IF EXISTS UploadSession;
+DROP TABLE IF EXISTS VideoStatisticsHistory;
+
+CREATE TABLE TargetVideo (
+    id VARCHAR(32) NOT NULL PRIMARY KEY,
+    videoType VARCHAR(16) NOT NULL,
+    title TEXT NOT NULL,
+    description TEXT NULL,
+    publishedAt DATETIME NOT NULL,
+    liveStreamingDetails_scheduledStartTime DATETIME NULL,
+    liveStreamingDetails_actualStartTime DATETIME NULL,
+    liveStreamingDetails_actualEndTime DATETIME NULL,
+    categoryId VARCHAR(8) NULL,
+    tags JSON NULL,
+    thumbnails_url TEXT NULL,
+    commentCount BIGINT NULL,
+    likeCount BIGINT NULL,
+    viewCount BIGINT NULL,
+    isShorts TINYINT(1) NULL DEFAULT NULL,
+    isDownloaded TINYINT(1) NOT NULL DEFAULT 0,
+    isPushed TINYINT(1) NOT NULL DEFAULT 0,
+    uploadVideoId VARCHAR(32) NULL DEFAULT NULL,
+    leaseOwner VARCHAR(64) NULL DEFAULT NULL,
+    leaseExpiresAt DATETIME NULL DEFAULT NULL,
+    pushedHash CHAR(64) NULL DEFAULT NULL,
+    contentHash CHAR(64) NULL DEFAULT NULL,
+    channelId VARCHAR(32) NULL DEFAULT NULL,
+    channelTitle TEXT NULL,
+    failedAttempts INT NOT NULL DEFAULT 0,
+    nextAttemptAt DATETIME NULL DEFAULT NULL,
+    lastError TEXT NULL,
+    isThumbnailPending TINYINT(1) NOT NULL DEFAULT 0,
+    INDEX idx_TargetVideo_queue (isPushed, isDownloaded, publishedAt),
+    INDEX idx_TargetVideo_channel_queue (channelId, isPushed, isDownloaded, publishedAt),
+    INDEX idx_TargetVideo_leaseOwner (leaseOwner)
+);
+
+CREATE TABLE QuotaData (
+    name VARCHAR(64) NOT NULL PRIMARY KEY,
+    identityFile TEXT NULL,
+    quota INT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE UploadSession (
+    videoId VARCHAR(32) NOT NULL PRIMARY KEY,
+    uploaderName VARCHAR(64) NOT NULL,
+    sessionUri TEXT NOT NULL,
+    progress BIGINT NOT NULL DEFAULT 0,
+    fileSize BIGINT NOT NULL,
+    updatedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+CREATE TABLE VideoStatisticsHistory (
+    videoId VARCHAR(32) NOT NULL,
+    recordedAt DATETIME NOT NULL,
+    viewCount BIGINT NULL,
+    likeCount BIGINT NULL,
+    commentCount BIGINT NULL,
+    PRIMARY KEY (videoId, recordedAt)
+);
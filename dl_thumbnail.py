@@ -1,9 +1,7 @@
 import os
-import asyncio
-import urllib.request
-import pandas as pd
 from dotenv import load_dotenv, find_dotenv
 from modules.db import DBManager
+from modules.youtube_dl import get_thumbnail_fetcher
 
 
 load_dotenv(find_dotenv())
@@ -17,19 +15,12 @@ db = DBManager(
 )
 
 
-def download_youtube_thumbnail(filename, target_dir, url):
-    file_name = f'{target_dir}/{filename}.jpg'
-    print(f"[urllib.request] Downloading thumbnail: {file_name}")
-    urllib.request.urlretrieve(url, file_name)
-    return file_name
-
 if __name__ == "__main__":
-    thumbnails = asyncio.run(
+    thumbnails = db.run(
         db.query("SELECT title, thumbnails_url FROM TargetVideo ORDER BY publishedAt ASC;")
     )
     print(thumbnails)
-    for i, thumb in thumbnails.iterrows():
-        if i > 509:
-            print(thumb)
-            title = thumb['title'][:12].replace("/","").replace("|","")
-            download_youtube_thumbnail(f"{i}", "img", thumb["thumbnails_url"])
\ No newline at end of file
+    # 更新されていないサムネイルはキャッシュから配置する
+    items = [(thumb["thumbnails_url"], f"img/{i}.jpg") for i, thumb in thumbnails.iterrows() if i > 509]
+    get_thumbnail_fetcher().fetch_many(items)
+    print(f"Downloaded: {len(items)} thumbnails")
@@ -1,12 +1,15 @@
 import os
-import asyncio
+import time
 import datetime
+import argparse
 
 import pandas as pd
 from dotenv import load_dotenv, find_dotenv
 
 from modules.db import DBManager
+from modules.description import format_video_info, format_video_info_batch, push_hash
 from modules.youtube_uploader import YoutubeVideoManager
+from modules.temp_storage import TempStorage
 
 load_dotenv(find_dotenv())
 
@@ -19,94 +22,116 @@ db = DBManager(
 )
 
 youtube = YoutubeVideoManager(
-    upload_channel_id=os.getenv("UPLOAD_CHANNEL_ID"),
-    identity_file="identity/client_secret.json"
+    api_key=os.getenv("YOUTUBE_API_KEY"),
+    target_channel_id=os.getenv("TARGET_YOUTUBE_CHANNEL_ID"),
+    upload_channel_id=os.getenv("UPLOAD_YOUTUBE_CHANNEL_ID")
 )
 
-
-def format_video_info(video_data: dict):
-    title = video_data["title"]
-    video_info = ""
-    if video_data["videoType"] == "shorts":
-        video_info += "【#Shorts】\n"
-        title += "  #Shorts"
-    elif video_data["videoType"] == "liveArchive":
-        video_info += "【配信アーカイブ または プレミア公開 動画】\n"
-        video_info += f"配信・公開予定日時: {format_datetime(video_data['liveStreamingDetails_scheduledStartTime'])}\n" if video_data[
-            "liveStreamingDetails_scheduledStartTime"] is not None else "配信・公開予定日時: [指定なし]\n"
-        video_info += f"配信・公開開始日時: {format_datetime(video_data['liveStreamingDetails_actualStartTime'])}\n"
-        video_info += f"配信・公開終了日時: {format_datetime(video_data['liveStreamingDetails_actualEndTime'])}\n"
-    elif video_data["videoType"] == "video":
-        video_info += "【通常動画】\n"
-    else:
-        raise "Error: videoType is invalid."
-
-    video_info += f"投稿日時: {format_datetime(video_data['publishedAt'])}\n"
-    video_info += f"再生回数: {insert_comma(video_data['viewCount'])} 回\n" if video_data["viewCount"] is not None else "再生回数: [非公開]\n"
-    video_info += f"高評価数: {insert_comma(video_data['likeCount'])} 件\n" if video_data["likeCount"] is not None else "高評価数: [非公開]\n"
-    video_info += f"コメント数: {insert_comma(video_data['commentCount'])} 件\n" if video_data[
-        "commentCount"] is not None else "コメント数: [コメント無効]\n"
-    video_info += f"※ データは取得時点({datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')})のものです。\n\nこの動画は「Aqua Ch. 湊あくあ」さんの公式チャンネルから取得したアーカイブ動画です。"
-    video_info = f"{'#'*20}\n\n{video_info}\n\n{'#'*20}\n\n\n\n{video_data['description']}"
-
-    title = title.replace("u3000", "　")
-    video_info = video_info.replace("u3000", "　")
-    return title, video_info
+# 1回の実行で作る説明文は同じ取得日時にする
+FETCHED_AT = datetime.datetime.now()
 
 
 def get_video_data(id: str):
-    video_data = asyncio.run(
+    video_data = db.run(
         db.query(
             f"SELECT * FROM TargetVideo WHERE id = '{id}';"))
     if video_data.empty:
         print("Error: Video data is not found.")
-        return None, None
+        return None, None, None
     video_data = video_data.iloc[0]
     if video_data["uploadVideoId"] is None:
         uploaded_video_id = input("UploadedVideo ID: ")
-        video_data = asyncio.run(
+        video_data = db.run(
             db.query(
                 f"UPDATE TargetVideo SET uploadVideoId = '{uploaded_video_id}', isPushed = '1' WHERE id = '{id}';"))
-        video_data = asyncio.run(
+        video_data = db.run(
             db.query(
                 f"SELECT * FROM TargetVideo WHERE id = '{id}';")).iloc[0]
 
-    title, description = format_video_info(video_data)
+    title, description = format_video_info(video_data, FETCHED_AT)
     print(f"title: {title}")
-    return video_data, description
-
-
-def format_datetime(datetime_str):
-    if datetime_str is None:
-        return "[非公開]"
-    if type(datetime_str) == str:
-        return datetime.datetime.strptime(datetime_str, "%Y-%m-%d %H:%M:%S").strftime("%Y/%m/%d %H:%M:%S")
-    else:
-        return datetime_str.strftime("%Y/%m/%d %H:%M:%S")
-
-
-def insert_comma(text: str) -> str:
-    # 3文字ごとにカンマを挿入
-    text = int(text)
-    return str("{:,}".format(text))
-
-
-if __name__ == "__main__":
+    return video_data, title, description
+
+
+def push_video_info(video: pd.Series, title: str, description: str, fetched_at: datetime.datetime, uploader_name: str = None):
+    youtube.edit_video(
+        video_id=video["uploadVideoId"],
+        title=title,
+        description=description,
+        category_id=video["categoryId"],
+        tags=video["tags"],
+        uploader_name=uploader_name
+    )
+    db.run(db.query(
+        "UPDATE TargetVideo SET pushedHash = :pushedHash WHERE id = :id;",
+        {"pushedHash": push_hash(title, description, video["tags"], fetched_at), "id": video["id"]}))
+
+
+def batch_edit(max_concurrency: int, dry_run: bool = False):
+    # アップロード済みの動画の説明文をまとめて作り直し、前回送った内容から変わったものだけを更新する
+    videos = db.run(db.query(
+        "SELECT * FROM TargetVideo WHERE isPushed = 1 AND uploadVideoId IS NOT NULL ORDER BY publishedAt ASC;"))
+    if videos.empty:
+        print("No uploaded videos.")
+        return
+
+    rendered = format_video_info_batch(videos, FETCHED_AT)
+    hashes = [push_hash(title, description, tags, FETCHED_AT)
+              for title, description, tags in zip(rendered["title"], rendered["description"], videos["tags"])]
+    changed = videos[pd.Series(hashes, index=videos.index) != videos["pushedHash"]]
+    print(f"変更がある動画：{len(changed)}本 / {len(videos)}本")
+    if dry_run or changed.empty:
+        return
+
+    # アップローダーごとにクォータの範囲内で並行して更新する
+    start_time = time.time()
+    dispatcher = youtube.start_dispatcher(max_concurrency, quota_cost=50)
+    futures = {}
+    for index, video in changed.iterrows():
+        title, description = rendered.at[index, "title"], rendered.at[index, "description"]
+        futures[video["id"]] = dispatcher.submit(
+            lambda uploader_name, video=video, title=title, description=description:
+                push_video_info(video, title, description, FETCHED_AT, uploader_name),
+            channel_id=video["channelId"])
+
+    failed = 0
+    for i, (video_id, future) in enumerate(futures.items()):
+        try:
+            future.result()
+        except Exception as e:
+            failed += 1
+            print(f"\nFailed to update {video_id}: {e}")
+        print(f"\rProgress: {i + 1}/{len(futures)}   time: {int(time.time() - start_time)} sec", end="")
+    dispatcher.shutdown()
+    print(f"\n更新しました：{len(futures) - failed}本 (失敗: {failed}本)")
+
+
+def interactive_edit():
     while True:
         id = input("Enter the video ID (targetChannel): ")
         if id == "":
             break
-        video, description = get_video_data(id)
-        youtube.edit_video(
-            video_id=video["uploadVideoId"],
-            title=video["title"],
-            description=description,
-            category_id=video["categoryId"],
-            tags=video["tags"]
-        )
-        remove_files = [f"temp/thumbnails/{id}.jpg", f"temp/videos/{id}.mp4"]
-        for f in remove_files:
-            if os.path.exists(f):
-                os.remove(f)
-        asyncio.run(
+        video, title, description = get_video_data(id)
+        if video is None:
+            continue
+        push_video_info(video, title, description, FETCHED_AT)
+        TempStorage("temp").release(id)
+        db.run(
             db.query(f"UPDATE TargetVideo SET isDownloaded = '0' WHERE id = '{id}';"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="アップロード済みの動画のタイトル・説明文・タグを更新する")
+    parser.add_argument("--batch", action="store_true", help="変更があった動画をすべて更新する")
+    parser.add_argument("--dry-run", action="store_true", help="更新が必要な本数だけを表示する (--batch と併用)")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("UPLOAD_CONCURRENCY", "2")),
+                        help="同時に更新する本数")
+    args = parser.parse_args()
+
+    try:
+        if args.batch:
+            batch_edit(args.concurrency, args.dry_run)
+        else:
+            interactive_edit()
+    finally:
+        youtube.quota_ledger.close()
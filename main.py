@@ -1,23 +1,40 @@
 import os
-import json
 import time
+import signal
+import argparse
 import datetime
-import asyncio
 import threading
+import queue
+import collections
+import concurrent.futures
 
-import schedule
 import pandas as pd
-import requests
 from dotenv import load_dotenv, find_dotenv
 from term_printer import Color, cprint
 
 from modules.db import DBManager
-from modules.youtube_dl import download_youtube_video, download_youtube_thumbnail
+from modules.description import format_video_info, push_hash
+from modules.feed import FeedServer, subscribe
+from modules.job_queue import TargetVideoQueue, CLAIMABLE
+from modules.metrics import metrics
+from modules.notifier import WebhookNotifier
+from modules.temp_storage import TempStorage
+from modules.quota import QUOTA_RESET_TIME
+from modules.scheduler import TimerScheduler
+from modules.youtube_dl import YoutubeDownloader, download_youtube_thumbnail
 from modules.youtube_uploader import YoutubeVideoManager
 
 
 load_dotenv(find_dotenv())
 
+# 処理時間・転送量などの計測結果の出力先 (指定した場合のみ。観測ごとに1行追記するので調査時だけ使う)
+metrics.configure(
+    jsonl_path=os.getenv("METRICS_FILE") or None,
+    port=int(os.getenv("METRICS_PORT", "0"))
+)
+
+notifier = WebhookNotifier(os.getenv("DISCORD_WEBHOOK_URL"))
+
 db = DBManager(
     db_user=os.getenv("DB_USER"),
     db_password=os.getenv("DB_PASSWORD"),
@@ -30,54 +47,71 @@ youtube = YoutubeVideoManager(
     api_key=os.getenv("YOUTUBE_API_KEY"),
     target_channel_id=os.getenv("TARGET_YOUTUBE_CHANNEL_ID"),
     upload_channel_id=os.getenv("UPLOAD_YOUTUBE_CHANNEL_ID"),
-    max_threads=20
+    max_threads=20,
+    refresh_statistics=os.getenv("SYNC_REFRESH_STATISTICS", "1") == "1",
+    db_batch_size=int(os.getenv("SYNC_DB_BATCH_SIZE", "500")),
+    fetch_threads=int(os.getenv("SYNC_FETCH_THREADS", "4")),
+    upload_chunk_size=int(os.getenv("UPLOAD_CHUNK_MB", "64")) * 1024 * 1024
 )
 
+# チャンネルが複数ある場合は、重みに応じた割合で各チャンネルの動画を処理する
+target_queue = TargetVideoQueue(
+    db,
+    lease_seconds=int(os.getenv("LEASE_SECONDS", str(60*30))),
+    channel_weights=youtube.channels,
+    max_attempts=int(os.getenv("RETRY_MAX_ATTEMPTS", "5")),
+    retry_seconds=int(os.getenv("RETRY_DELAY_SECONDS", str(60*30)))
+)
 
-def format_video_info(video_data: dict):
-    title = video_data["title"]
-    video_info = ""
-    if video_data["videoType"] == "shorts":
-        video_info += "【#Shorts】\n"
-        title += "  #Shorts"
-    elif video_data["videoType"] == "liveArchive":
-        video_info += "【配信アーカイブ または プレミア公開 動画】\n"
-        video_info += f"配信・公開予定日時: {format_datetime(video_data['liveStreamingDetails_scheduledStartTime'])}\n" if video_data["liveStreamingDetails_scheduledStartTime"] is not None else "配信・公開予定日時: [指定なし]\n"
-        video_info += f"配信・公開開始日時: {format_datetime(video_data['liveStreamingDetails_actualStartTime'])}\n"
-        video_info += f"配信・公開終了日時: {format_datetime(video_data['liveStreamingDetails_actualEndTime'])}\n"
-    elif video_data["videoType"] == "video":
-        video_info += "【通常動画】\n"
-    else:
-        raise "Error: videoType is invalid."
-
-    video_info += f"投稿日時: {format_datetime(video_data['publishedAt'])}\n"
-    video_info += f"再生回数: {insert_comma(video_data['viewCount'])} 回\n" if video_data["viewCount"] is not None else "再生回数: [非公開]\n"
-    video_info += f"高評価数: {insert_comma(video_data['likeCount'])} 件\n" if video_data["likeCount"] is not None else "高評価数: [非公開]\n"
-    video_info += f"コメント数: {insert_comma(video_data['commentCount'])} 件\n" if video_data["commentCount"] is not None else "コメント数: [コメント無効]\n"
-    video_info += f"※ データは取得時点({datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')})のものです。\n\nこの動画は「Aqua Ch. 湊あくあ」さんの公式チャンネルから取得したアーカイブ動画です。"
-    video_info = f"{'#'*20}\n\n{video_info}\n\n{'#'*20}\n\n\n\n{video_data['description']}"
-
-    title = title.replace("u3000", "　")
-    video_info = video_info.replace("u3000", "　")
-    return title, video_info
+# アップロード中に先読みしておく動画の本数 (0で逐次処理)
+PREFETCH_VIDEOS = int(os.getenv("PREFETCH_VIDEOS", "2"))
+# temp/videos と temp/thumbnails の合計サイズの上限
+TEMP_MAX_BYTES = int(float(os.getenv("PREFETCH_MAX_GB", "50")) * 1024**3)
+# 同時にアップロードする本数 (アップローダーごとに1本まで)
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "2"))
+
+# デーモンモードで動画データを同期する間隔 (分)
+DAEMON_SYNC_MINUTES = float(os.getenv("DAEMON_SYNC_MINUTES", "30"))
+# 新着通知を受け取ってから同期するまでの待ち時間 (秒, 続けて届いた通知をまとめる)
+FEED_SYNC_DELAY = float(os.getenv("FEED_SYNC_DELAY", "60"))
+
+temp_storage = TempStorage("temp", max_bytes=TEMP_MAX_BYTES)
+scheduler = TimerScheduler()
+
+downloader = YoutubeDownloader(
+    temp_storage.video_dir,
+    concurrent_fragments=int(os.getenv("DL_CONCURRENT_FRAGMENTS", "4")),
+    rate_limit=int(float(os.getenv("DL_RATE_LIMIT_MB", "0")) * 1024**2) or None,
+    throttled_rate=int(float(os.getenv("DL_THROTTLED_RATE_KB", "100")) * 1024) or None,
+    parallel_streams=os.getenv("DL_PARALLEL_STREAMS", "1") == "1"
+)
 
 
+def download_video(video: pd.DataFrame, startTime: float, stop_event: threading.Event = None, block: bool = True):
+    # 一時ファイルの容量に収まる場合だけダウンロードする
+    if not temp_storage.admit(video["id"], downloader.estimate_size(video["id"]), stop_event, block):
+        downloader.clear_info(video["id"])
+        return None, None
 
-def download_video(video: pd.DataFrame, startTime: float):
-    progress_time = time.time()
-    video_file_path = download_youtube_video(video["id"], "temp/videos")
-    cprint(f"Downloaded: {video_file_path}", attrs=[Color.BRIGHT_GREEN])
-    print(f"Time: {time.time() - progress_time:.2f} sec")
-    print(f"Total Time: {time.time() - startTime:.2f} sec\n")
+    try:
+        progress_time = time.time()
+        video_file_path = downloader.download(video["id"])
+        cprint(f"Downloaded: {video_file_path}", attrs=[Color.BRIGHT_GREEN])
+        print(f"Time: {time.time() - progress_time:.2f} sec")
+        print(f"Total Time: {time.time() - startTime:.2f} sec\n")
 
-    progress_time = time.time()
-    thumbnail_file_path = download_youtube_thumbnail(video["id"], "temp/thumbnails", video["thumbnails_url"])
-    cprint(f"Downloaded: {thumbnail_file_path} (thumbnail)", attrs=[Color.BRIGHT_GREEN])
-    print(f"Time: {time.time() - progress_time:.2f} sec")
-    print(f"Total Time: {time.time() - startTime:.2f} sec\n")
+        progress_time = time.time()
+        thumbnail_file_path = download_youtube_thumbnail(video["id"], temp_storage.thumbnail_dir, video["thumbnails_url"])
+        cprint(f"Downloaded: {thumbnail_file_path} (thumbnail)", attrs=[Color.BRIGHT_GREEN])
+        print(f"Time: {time.time() - progress_time:.2f} sec")
+        print(f"Total Time: {time.time() - startTime:.2f} sec\n")
+    except Exception:
+        temp_storage.forget(video["id"])
+        raise
+    temp_storage.set_state(video["id"], "ready")
 
     # Update database
-    asyncio.run(
+    db.run(
         db.query(
             f"UPDATE TargetVideo SET isDownloaded = 1 WHERE id = '{video['id']}';"
         )
@@ -85,18 +119,21 @@ def download_video(video: pd.DataFrame, startTime: float):
     return video_file_path, thumbnail_file_path
 
 
-def upload_video(video: pd.DataFrame, video_file_path: str, thumbnail_file_path: str, startTime: float):
+def upload_video(video: pd.DataFrame, video_file_path: str, thumbnail_file_path: str, startTime: float, uploader_name: str = None):
     progress_time = time.time()
     cprint(f"Upload Progress: {video['title']}", attrs=[Color.BRIGHT_YELLOW])
 
-    title, description = format_video_info(video)
+    fetched_at = datetime.datetime.now()
+    title, description = format_video_info(video, fetched_at)
     response = youtube.upload_video(
         video_file_path=video_file_path,
         title=title,
         description=description,
         category_id=video["categoryId"],
         thumbnail_file_path=thumbnail_file_path,
-        tags=video["tags"]
+        tags=video["tags"],
+        uploader_name=uploader_name,
+        video_id=video["id"]
     )
 
     cprint(f"Uploaded: {video['title']}", attrs=[Color.BRIGHT_GREEN])
@@ -104,70 +141,133 @@ def upload_video(video: pd.DataFrame, video_file_path: str, thumbnail_file_path:
     print(f"Total Time: {time.time() - startTime:.2f} sec\n")
 
     # Update database
-    asyncio.run(
+    # pushedHash は edit_video.py --batch で変更があった動画だけを更新するために使う
+    db.run(
         db.query(
-            f"UPDATE TargetVideo SET isPushed = 1, uploadVideoId = '{response['id']}' WHERE id = '{video['id']}';"
+            "UPDATE TargetVideo SET isPushed = 1, uploadVideoId = :uploadVideoId, pushedHash = :pushedHash WHERE id = :id;",
+            {"uploadVideoId": response["id"],
+             "pushedHash": push_hash(title, description, video["tags"], fetched_at),
+             "id": video["id"]}
         )
     )
 
 
-def delete_temp_files(video: pd.DataFrame, video_file_path: str, thumbnail_file_path: str):
-    temp_files = [video_file_path, thumbnail_file_path]
-    for temp_file in temp_files:
-        os.remove(temp_file)
-        print(f"Removed: {temp_file}")
-        # Update database
-        asyncio.run(
-            db.query(
-                f"UPDATE TargetVideo SET isDownloaded = 0 WHERE id = '{video['id']}';"
-            )
+def delete_temp_files(video: pd.DataFrame):
+    temp_storage.release(video["id"])
+    # Update database
+    db.run(
+        db.query(
+            f"UPDATE TargetVideo SET isDownloaded = 0 WHERE id = '{video['id']}';"
         )
+    )
 
 
 
+def cleanup_temp_files():
+    # 処理待ちでない動画 (アップロード済み・再試行の上限に達したもの) の一時ファイルを削除する
+    pending_videos = db.run(db.query(
+        "SELECT id FROM TargetVideo WHERE isPushed = 0 AND failedAttempts < :maxAttempts;",
+        {"maxAttempts": target_queue.max_attempts}))
+    temp_storage.cleanup_orphans(set(pending_videos["id"]) if not pending_videos.empty else set())
+
+
+def find_remain_videos() -> pd.DataFrame:
+    remain_videos = db.run(
+        db.query(
+            f"SELECT id FROM TargetVideo WHERE isDownloaded = 1 AND {CLAIMABLE} ORDER BY publishedAt ASC;",
+            {"maxAttempts": target_queue.max_attempts}
+        )
+    )
+    # 他のマシンでダウンロードされた動画は除く
+    if not remain_videos.empty:
+        remain_videos = remain_videos[remain_videos["id"].map(lambda video_id: downloader.find_file(video_id) is not None)]
+    return remain_videos
+
+
+def record_failure(video: pd.DataFrame, error: Exception, stage: str):
+    # 失敗した動画は時間を空けて再試行し、上限に達したら取得しない (他の動画の処理は続ける)
+    cprint(f"[{stage}] Failed: {video['title']}  ({video['id']})\n{error}", attrs=[Color.RED])
+    post_webhook(f"[{stage}] Failed: {video['title']}  ({video['id']})\n{error}")
+    db.run(target_queue.fail(video["id"], f"{stage}: {error}"))
+
+
+def retry_thumbnails():
+    # アップロード後にサムネイルの設定に失敗した動画は、動画を送り直さずにサムネイルだけを設定し直す
+    videos = db.run(db.query(
+        "SELECT id, title, uploadVideoId, thumbnails_url FROM TargetVideo"
+        " WHERE isPushed = 1 AND isThumbnailPending = 1 AND uploadVideoId IS NOT NULL AND failedAttempts < :maxAttempts;",
+        {"maxAttempts": target_queue.max_attempts}))
+    for i in range(len(videos)):
+        video = videos.iloc[i]
+        try:
+            thumbnail_file_path = download_youtube_thumbnail(video["id"], temp_storage.thumbnail_dir, video["thumbnails_url"])
+            try:
+                response = youtube.upload_thumbnail(video["uploadVideoId"], thumbnail_file_path)
+            finally:
+                os.remove(thumbnail_file_path)
+        except Exception as e:
+            cprint(f"[Thumbnail] Failed: {video['title']}  ({video['id']})\n{e}", attrs=[Color.RED])
+            db.run(db.query(
+                "UPDATE TargetVideo SET failedAttempts = failedAttempts + 1, lastError = :error WHERE id = :id;",
+                {"id": video["id"], "error": f"Thumbnail: {e}"[:1000]}))
+            continue
+        if response is None:
+            # クォータが残っていないので、次のリセット後に設定する
+            break
+        db.run(db.query("UPDATE TargetVideo SET isThumbnailPending = 0 WHERE id = :id;", {"id": video["id"]}))
+        cprint(f"[Thumbnail] Complete: {video['title']}  ({video['id']})", attrs=[Color.GREEN])
+
+
+def upload_remain_videos(remain_videos: pd.DataFrame):
+    startTime = time.time()
+    claimed_videos = db.run(target_queue.claim(len(remain_videos), downloaded=True, ids=list(remain_videos["id"])))
+    for i in range(len(claimed_videos)):
+        video = claimed_videos.iloc[i]
+        cprint(f"\nProgress:  ({i + 1}/{len(remain_videos)}) {video['title']}", attrs=[Color.BRIGHT_YELLOW])
+        post_webhook(f"\nProgress:  ({i + 1}/{len(remain_videos)}) {video['title']}", key="progress")
+
+        post_webhook(f"[Upload] Start: {video['title']}  ({video['id']})")
+        progress_time = time.time()
+        video_file_path = downloader.find_file(video["id"])
+        thumbnail_file_path = temp_storage.thumbnail_path(video["id"])
+        temp_storage.set_state(video["id"], "uploading")
+        try:
+            upload_video(video, video_file_path, thumbnail_file_path, startTime)
+        except Exception as e:
+            temp_storage.forget(video["id"])
+            record_failure(video, e, "Upload")
+            continue
+        post_webhook(f"[Upload] Complete: {video['title']}  ({video['id']})")
+
+        delete_temp_files(video)
+        db.run(target_queue.release(video["id"]))
+
+        cprint(f"Finished: {video['title']}", attrs=[Color.GREEN])
+        post_webhook(f"Finished: {video['title']}  ({video['id']})\nTotal Time: {time.time() - startTime:.2f} sec")
+        print(f"Time: {time.time() - progress_time:.2f} sec")
+        print(f"Total Time [remained_videos]: {time.time() - startTime:.2f} sec\n")
+
+    post_webhook(f"前回の処理でアップロードされていなかった動画のアップロードが完了しました。\nTotal Time: {time.time() - startTime:.2f} sec")
+    cprint("\n前回の処理でアップロードされていなかった動画のアップロードが完了しました。", attrs=[Color.MAGENTA])
+    print(f"Total Time [remained_videos]: {time.time() - startTime:.2f} sec\n")
+
+
 def CLI_dl_and_up():
     cprint("Youtube動画データを取得・更新しました。", attrs=[Color.BRIGHT_GREEN])
     cprint("ダウンロードを開始するにはEnterキーを押してください。", attrs=[Color.BRIGHT_GREEN], end="")
     input()
 
-    # 前回の処理でアップロードされていない動画があるか確認
-    remain_videos = asyncio.run(
-        db.query(
-            "SELECT id FROM TargetVideo WHERE isDownloaded = 1 AND isPushed = 0 ORDER BY publishedAt ASC;"
-        )
-    )
+    cleanup_temp_files()
+    retry_thumbnails()
 
+    # 前回の処理でアップロードされていない動画があるか確認
+    remain_videos = find_remain_videos()
     if not remain_videos.empty:
         cprint(f"前回の処理でアップロードされていない動画が{len(remain_videos)}本あります。", attrs=[Color.BRIGHT_RED])
         cprint("アップロードを続行しますか？ (y/n): ", attrs=[Color.CYAN], end="")
         is_upload_remain = input()
         if is_upload_remain == "y" or is_upload_remain == "Y" or is_upload_remain == "yes" or is_upload_remain == "Yes":
-            startTime = time.time()
-            for i in range(len(remain_videos)):
-                video = asyncio.run(db.query(f"SELECT * FROM TargetVideo WHERE isDownloaded = 1 AND isPushed = 0 ORDER BY publishedAt ASC LIMIT 1;"))
-                if video.empty:
-                    continue
-                video = video.iloc[0]
-                cprint(f"\nProgress:  ({i + 1}/{len(remain_videos)}) {video['title']}", attrs=[Color.BRIGHT_YELLOW])
-                post_webhook(f"\nProgress:  ({i + 1}/{len(remain_videos)}) {video['title']}")
-
-                post_webhook(f"[Upload] Start: {video['title']}  ({video['id']})")
-                progress_time = time.time()
-                video_file_path = f"temp/videos/{video['id']}.mp4"
-                thumbnail_file_path = f"temp/thumbnails/{video['id']}.jpg"
-                upload_video(video, video_file_path, thumbnail_file_path, startTime)
-                post_webhook(f"[Upload] Complete: {video['title']}  ({video['id']})")
-
-                delete_temp_files(video, video_file_path, thumbnail_file_path)
-
-                cprint(f"Finished: {video['title']}", attrs=[Color.GREEN])
-                post_webhook(f"Finished: {video['title']}  ({video['id']})\nTotal Time: {time.time() - startTime:.2f} sec")
-                print(f"Time: {time.time() - progress_time:.2f} sec")
-                print(f"Total Time [remained_videos]: {time.time() - startTime:.2f} sec\n")
-
-            post_webhook(f"前回の処理でアップロードされていなかった動画のアップロードが完了しました。\nTotal Time: {time.time() - startTime:.2f} sec")
-            cprint("\n前回の処理でアップロードされていなかった動画のアップロードが完了しました。", attrs=[Color.MAGENTA])
-            print(f"Total Time [remained_videos]: {time.time() - startTime:.2f} sec\n")
+            upload_remain_videos(remain_videos)
 
     cprint("\n何本の動画をダウンロードしますか？ (投稿日時が古いものから処理します): ", attrs=[Color.CYAN], end="")
     output_video_number = input()
@@ -190,98 +290,331 @@ def CLI_dl_and_up():
 
     print(f"\nGetting {output_video_number} videos...")
     startTime = time.time()
-    for i in range(output_video_number):
-        video = asyncio.run(db.query(f"SELECT * FROM TargetVideo WHERE isDownloaded = 0 AND isPushed = 0 ORDER BY publishedAt ASC LIMIT 1;"))
-        if video.empty:
-            continue
-        video = video.iloc[0]
-        cprint(f"\nProgress:  ({i + 1}/{output_video_number}) {video['title']}", attrs=[Color.BRIGHT_YELLOW])
-        post_webhook(f"\nProgress:  ({i + 1}/{output_video_number}) {video['title']}")
-
-        post_webhook(f"[Download] Start: {video['title']}  ({video['id']})")
-        progress_time = time.time()
-        video_file_path, thumbnail_file_path = download_video(video, startTime)
-        post_webhook(f"[Download] Complete: {video['title']}  ({video['id']})")
-
-        if is_upload:
-            post_webhook(f"[Upload] Start: {video['title']}  ({video['id']})")
-            upload_video(video, video_file_path, thumbnail_file_path, startTime)
-            post_webhook(f"[Upload] Complete: {video['title']}  ({video['id']})")
+    if is_upload and PREFETCH_VIDEOS > 0:
+        # ダウンロードとアップロードを並行して処理する
+        pipeline_dl_and_up(output_video_number, startTime)
+    else:
+        for i in range(output_video_number):
+            video = db.run(target_queue.claim_next())
+            if video.empty:
+                continue
+            video = video.iloc[0]
+            cprint(f"\nProgress:  ({i + 1}/{output_video_number}) {video['title']}", attrs=[Color.BRIGHT_YELLOW])
+            post_webhook(f"\nProgress:  ({i + 1}/{output_video_number}) {video['title']}", key="progress")
+
+            post_webhook(f"[Download] Start: {video['title']}  ({video['id']})")
+            progress_time = time.time()
+            # アップロードしない場合は容量が空かないので、上限に達したら終了する
+            try:
+                video_file_path, thumbnail_file_path = download_video(video, startTime, block=is_upload)
+            except Exception as e:
+                record_failure(video, e, "Download")
+                continue
+            if video_file_path is None:
+                db.run(target_queue.release(video["id"]))
+                cprint("一時ファイルの容量の上限に達したため、ダウンロードを終了します。", attrs=[Color.RED])
+                break
+            post_webhook(f"[Download] Complete: {video['title']}  ({video['id']})")
+
+            if is_upload:
+                post_webhook(f"[Upload] Start: {video['title']}  ({video['id']})")
+                try:
+                    upload_video(video, video_file_path, thumbnail_file_path, startTime)
+                except Exception as e:
+                    temp_storage.forget(video["id"])
+                    record_failure(video, e, "Upload")
+                    continue
+                post_webhook(f"[Upload] Complete: {video['title']}  ({video['id']})")
 
-            delete_temp_files(video, video_file_path, thumbnail_file_path)
+                delete_temp_files(video)
+            db.run(target_queue.release(video["id"]))
 
-        cprint(f"Finished: {video['title']}", attrs=[Color.GREEN])
-        post_webhook(f"Finished: {video['title']}  ({video['id']})\nTotal Time: {time.time() - startTime:.2f} sec")
-        print(f"Time: {time.time() - progress_time:.2f} sec")
-        print(f"Total Time: {time.time() - startTime:.2f} sec\n")
+            cprint(f"Finished: {video['title']}", attrs=[Color.GREEN])
+            post_webhook(f"Finished: {video['title']}  ({video['id']})\nTotal Time: {time.time() - startTime:.2f} sec")
+            print(f"Time: {time.time() - progress_time:.2f} sec")
+            print(f"Total Time: {time.time() - startTime:.2f} sec\n")
 
 
     cprint("\nダウンロード・アップロードが完了しました。", attrs=[Color.MAGENTA])
     print(f"Total Time: {time.time() - startTime:.2f} sec\n")
+    metrics.record_stage("dl_and_up", time.time() - startTime)
     post_webhook(f"すべての動画のダウンロード・アップロードが完了しました。\nTotal Time: {time.time() - startTime:.2f} sec")
 
 
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+def prefetch_videos(output_video_number: int, video_queue: queue.Queue, space: threading.Condition, stop_event: threading.Event, startTime: float):
+    # アップロード中に次の動画を先読みしてダウンロードする
+    # isDownloaded はファイルが揃ってから立てるので、途中で止まっても次回の「前回の処理」で拾える
+    # video_queue は PREFETCH_VIDEOS 本までなので、すべてのアップローダーがクォータ待ちの間だけは backlog に溜めて
+    # 一時ファイルの容量の上限まで先読みを続ける
+    backlog = collections.deque()
+
+    def flush_backlog() -> bool:
+        # backlog をキューに移し、キューに空きが残っているかを返す
+        while backlog:
+            try:
+                video_queue.put_nowait(backlog[0])
+            except queue.Full:
+                return False
+            backlog.popleft()
+        return not video_queue.full()
+
+    def can_prefetch() -> bool:
+        # クォータが残っているアップローダーが1つでもあれば、PREFETCH_VIDEOS 本までにする
+        return stop_event.is_set() or flush_backlog() or youtube.quota_ledger.is_waiting(youtube.uploader)
 
+    try:
+        for i in range(output_video_number):
+            # アップロードでキューから取り出されるか、すべてのアップローダーがクォータ待ちに入るまで待つ
+            with space:
+                space.wait_for(can_prefetch)
+            if stop_event.is_set():
+                return
+
+            video = db.run(target_queue.claim_next())
+            if video.empty:
+                break
+            video = video.iloc[0]
+            cprint(f"\nProgress:  ({i + 1}/{output_video_number}) {video['title']}", attrs=[Color.BRIGHT_YELLOW])
+            post_webhook(f"\nProgress:  ({i + 1}/{output_video_number}) {video['title']}", key="progress")
+
+            post_webhook(f"[Download] Start: {video['title']}  ({video['id']})")
+            try:
+                video_file_path, thumbnail_file_path = download_video(video, startTime, stop_event)
+            except Exception as e:
+                record_failure(video, e, "Download")
+                continue
+            if video_file_path is None:
+                db.run(target_queue.release(video["id"]))
+                return
+            post_webhook(f"[Download] Complete: {video['title']}  ({video['id']})")
+
+            backlog.append((video, video_file_path, thumbnail_file_path))
+            with space:
+                flush_backlog()
 
-def format_datetime(datetime_str):
-    if datetime_str is None:
-        return "[非公開]"
-    if type(datetime_str) == str:
-        return datetime.datetime.strptime(datetime_str, "%Y-%m-%d %H:%M:%S").strftime("%Y/%m/%d %H:%M:%S")
+    except Exception as e:
+        backlog.append(e)
     else:
-        return datetime_str.strftime("%Y/%m/%d %H:%M:%S")
+        backlog.append(None)
+
+    # 残りをすべてキューに渡してから終了する
+    with space:
+        space.wait_for(lambda: stop_event.is_set() or (flush_backlog() or not backlog))
 
 
-def insert_comma(text: str) -> str:
-    # 3文字ごとにカンマを挿入
-    text = int(text)
-    return str("{:,}".format(text))
+def upload_and_cleanup(video: pd.DataFrame, video_file_path: str, thumbnail_file_path: str, startTime: float, uploader_name: str = None):
+    progress_time = time.time()
+    temp_storage.set_state(video["id"], "uploading")
+    post_webhook(f"[Upload] Start: {video['title']}  ({video['id']})")
+    try:
+        upload_video(video, video_file_path, thumbnail_file_path, startTime, uploader_name)
+    except Exception as e:
+        # ダウンロード済みのファイルは残し、次回の「前回の処理」で再試行する
+        # 再試行するまでは管理対象から外し、容量の空き待ちがこのファイルを待ち続けないようにする
+        temp_storage.forget(video["id"])
+        record_failure(video, e, "Upload")
+        return
+    post_webhook(f"[Upload] Complete: {video['title']}  ({video['id']})")
+
+    delete_temp_files(video)
+    db.run(target_queue.release(video["id"]))
+
+    cprint(f"Finished: {video['title']}", attrs=[Color.GREEN])
+    post_webhook(f"Finished: {video['title']}  ({video['id']})\nTotal Time: {time.time() - startTime:.2f} sec")
+    print(f"Time: {time.time() - progress_time:.2f} sec")
+    print(f"Total Time: {time.time() - startTime:.2f} sec\n")
+
+
+def pipeline_dl_and_up(output_video_number: int, startTime: float):
+    # アップローダーごとに並行してアップロードする (アップローダーがない場合は先読みを始める前に止める)
+    dispatcher = youtube.start_dispatcher(max_concurrency=UPLOAD_CONCURRENCY)
+
+    video_queue = queue.Queue(max(PREFETCH_VIDEOS, 1))
+    # キューから取り出したとき・クォータ待ちに入ったとき・停止するときに先読みを起こす
+    space = threading.Condition()
+
+    def wake_prefetch():
+        with space:
+            space.notify_all()
+
+    stop_event = threading.Event()
+    prefetch_thread = threading.Thread(
+        target=prefetch_videos,
+        args=(output_video_number, video_queue, space, stop_event, startTime),
+        daemon=True
+    )
+    youtube.quota_ledger.add_waiting_listener(wake_prefetch)
+    prefetch_thread.start()
 
+    upload_slots = threading.Semaphore(UPLOAD_CONCURRENCY)
+    futures = []
 
-def post_webhook(description):
-    webhook_url = "https://discord.com/api/webhooks/1272407304284667925/adUs5sYJ36kGm7t_Zq_5iHNK0rDJWMG1UoORPZWj5JdToZFc82CgzDWr2PpmS3Q5pbng"
-    payload = {"content": description}
     try:
-        response = requests.post(webhook_url, json=payload, timeout=5)
-        response.raise_for_status()
-        response.close()
+        while True:
+            # アップロード枠が空くまで先読みキューから取り出さない
+            upload_slots.acquire()
+            item = video_queue.get()
+            wake_prefetch()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            for future in futures:
+                if future.done():
+                    future.result()
+
+            future = dispatcher.submit(
+                lambda uploader_name, item=item: upload_and_cleanup(*item, startTime, uploader_name=uploader_name),
+                channel_id=item[0]["channelId"])
+            future.add_done_callback(lambda _: upload_slots.release())
+            futures.append(future)
+
+        for future in futures:
+            future.result()
+    finally:
+        # ダウンロード途中・アップロード途中の動画は完了まで待ってからフラグを確定させる
+        stop_event.set()
+        wake_prefetch()
+        prefetch_thread.join()
+        youtube.quota_ledger.remove_waiting_listener(wake_prefetch)
+        # クォータ待ちで始まっていないアップロードはキャンセルする (次回の「前回の処理」で拾える)
+        dispatcher.shutdown()
+        concurrent.futures.wait(futures)
 
-    except TimeoutError:
-        print(f"Failed to send log to Discord: Timeout")
 
-    except Exception as e:
-        print(f"Failed to send log to Discord: {e}")
+def chunks(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
+
+
+def post_webhook(description, key: str = None):
+    # 送信はバックグラウンドで行うので、ダウンロード・アップロードを待たせない
+    notifier.post(description, key)
 
 
 def update_quota():
     query = "UPDATE QuotaData SET quota = 0;"
-    asyncio.run(db.query(query))
+    db.run(db.query(query))
+    youtube.quota_ledger.reset()
 
 
-def scheduler():
+def daemon_dl_and_up(work_event: threading.Event):
+    # 入力を待たずに、同期・新着通知のたびに未処理の動画をすべてダウンロード・アップロードする
     while True:
-        schedule.run_pending()
-        time.sleep(5)
+        # Ctrl+C を受け付けるようにタイムアウト付きで待つ
+        if not work_event.wait(60):
+            continue
+        work_event.clear()
+
+        startTime = time.time()
+        try:
+            # 再試行の上限に達した動画のファイルが容量を埋めないように、毎回片付ける
+            cleanup_temp_files()
+            retry_thumbnails()
+            # 前回の処理・アップロードに失敗した動画のうち、再試行できるものを先にアップロードする
+            remain_videos = find_remain_videos()
+            if not remain_videos.empty:
+                upload_remain_videos(remain_videos)
+                db.run(target_queue.release_all())
+
+            output_video_number = db.run(target_queue.pending_count())
+            if output_video_number == 0:
+                continue
+            pipeline_dl_and_up(output_video_number, startTime)
+        except Exception as e:
+            # 動画ごとの失敗は record_failure で記録済みなので、ここに来るのはDBなどの障害
+            cprint(f"Error: {e}", attrs=[Color.RED])
+            post_webhook(f"[Error] {e}")
+        finally:
+            db.run(target_queue.release_all())
+        metrics.record_stage("dl_and_up", time.time() - startTime)
+
+
+def start_feed_server():
+    port = int(os.getenv("FEED_PORT", "0"))
+    if not port:
+        return None
+    secret = os.getenv("FEED_SECRET") or None
+
+    def on_notify(video_ids):
+        print(f"Feed: {', '.join(video_ids)}")
+        scheduler.trigger("sync_videos", delay=FEED_SYNC_DELAY)
+
+    feed_server = FeedServer(
+        port,
+        on_notify,
+        channel_ids=youtube.target_channel_ids,
+        secret=secret,
+        host=os.getenv("FEED_HOST", "127.0.0.1"))
+    feed_server.start()
+
+    # 公開URLがある場合はハブへの購読を期限が切れる前に更新し続ける
+    callback_url = os.getenv("FEED_CALLBACK_URL")
+    if callback_url:
+        lease_seconds = 60*60*24*5
+
+        def subscribe_all():
+            for channel_id in youtube.target_channel_ids:
+                subscribe(channel_id, callback_url, secret, lease_seconds)
+
+        scheduler.every(lease_seconds * 0.8, subscribe_all, name="feed_subscribe", run_now=True)
+    return feed_server
+
+
+def main(daemon: bool = False):
+    work_event = threading.Event()
+
+    def sync_videos():
+        # 新しい動画だけを取得する (統計情報は1日1回更新する)
+        youtube.save_video_data(refresh_statistics=False)
+        work_event.set()
+
+    def sync_all_videos():
+        youtube.save_video_data()
+        work_event.set()
+
+    scheduler.daily_at(QUOTA_RESET_TIME, update_quota)
+    scheduler.daily_at("00:00", sync_all_videos)
+    if daemon:
+        scheduler.every(DAEMON_SYNC_MINUTES * 60, sync_videos)
+    scheduler.start()
 
+    youtube.save_video_data()
+    work_event.set()
 
+    feed_server = None
+    target_queue.start_heartbeat()
+    try:
+        if daemon:
+            feed_server = start_feed_server()
+            daemon_dl_and_up(work_event)
+        else:
+            CLI_dl_and_up()
+    except KeyboardInterrupt:
+        cprint("\n終了します。", attrs=[Color.BRIGHT_RED])
+    finally:
+        if feed_server is not None:
+            feed_server.stop()
+        scheduler.stop()
+        target_queue.stop_heartbeat()
+        db.run(target_queue.release_all())
+        youtube.quota_ledger.close()
+        metrics.close()
+        notifier.close()
 
-def main():
-    schedule.every().day.at("16:00").do(update_quota)
-    schedule.every().day.at("00:00").do(youtube.save_video_data)
-    schedule_thread = threading.Thread(target=scheduler)
-    schedule_thread.start()
 
-    youtube.save_video_data()
-    CLI_dl_and_up()
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Youtubeチャンネルの動画をアーカイブする")
+    parser.add_argument("--daemon", action="store_true",
+                        help="入力を待たずに、定期的な同期と新着通知のたびにダウンロード・アップロードする")
+    args = parser.parse_args()
 
+    # SIGTERM でも Ctrl+C と同じように片付けてから終了する
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
-if __name__ == "__main__":
     cprint("##### Start #####", attrs=[Color.BRIGHT_RED])
-    main()
+    main(args.daemon)
     cprint("##### End #####", attrs=[Color.BRIGHT_RED])
     os._exit(0)
@@ -1,11 +1,46 @@
-import os
-import re
-from datetime import datetime
+import ast
+import json
+import asyncio
+import threading
 
 import pandas as pd
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import text, bindparam
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from modules.metrics import metrics
+
+
+# JSONとして保存しているカラム (それ以外のカラムはそのまま返す)
+JSON_COLUMNS = ("tags",)
+
+
+def decode_json_column(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        # 旧形式 (Pythonのリスト表記) で保存されているデータ
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    # すべてのDBManagerで共有する常駐イベントループ (クエリごとにループを作り直さない)
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="DBManager-loop", daemon=True).start()
+    return _loop
 
 
 class DBManager:
@@ -14,55 +49,153 @@ class DBManager:
                  db_password:str,
                  db_host:str,
                  db_port:str,
-                 db_database:str) -> None:
-        url = f'mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_database}?charset=utf8mb4'
-        self.engine = create_engine(url,
-                                    pool_recycle=360,
-                                    echo=False)
+                 db_database:str,
+                 pool_size:int = 10,
+                 max_overflow:int = 10) -> None:
+        url = f'mysql+aiomysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_database}?charset=utf8mb4'
+        # 影響行数で追加・更新・変更なしを区別するため、FOUND_ROWS は無効にする
+        self.engine = create_async_engine(url,
+                                          pool_size=pool_size,
+                                          max_overflow=max_overflow,
+                                          pool_recycle=360,
+                                          pool_pre_ping=True,
+                                          echo=False,
+                                          connect_args={"client_flag": 0})
 
 
-    async def _format_response(self, data: pd.DataFrame) -> pd.DataFrame:
-        # 正規表現でリストを見つけ、リスト型に変換する
-        list_pattern = re.compile(r"\[.*?\]")
-        for column in data.columns:
-            data[column] = data[column].apply(lambda x: eval(x) if re.match(list_pattern, str(x)) else x)
+    def run(self, coro):
+        # 同期コードから呼び出すための窓口 (共有ループで実行して結果を待つ)
+        loop = get_event_loop()
+        if threading.current_thread().name == "DBManager-loop":
+            raise RuntimeError("DBManager.run() cannot be called from the DB event loop. Use await instead.")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
 
-        # 正規表現で辞書型を見つけ、辞書型に変換する
-        dict_pattern = re.compile(r"\{.*?\}")
-        for column in data.columns:
-            data[column] = data[column].apply(lambda x: eval(x) if re.match(dict_pattern, str(x)) else x)
+
+    async def _format_response(self, data: pd.DataFrame) -> pd.DataFrame:
+        # 構造化データのカラムだけをデコードする
+        for column in JSON_COLUMNS:
+            if column in data.columns:
+                data[column] = data[column].map(decode_json_column)
 
         return data
 
 
-    async def _commit(self, query) -> None:
-        with self.engine.connect() as conn:
-            with conn.begin():
-                try:
-                    conn.execute(text(query))
-                except IntegrityError as e:
-                    conn.rollback()
-                    raise Exception(f"IntegrityError: {e}")
-                else:
-                    return
+    async def _commit(self, query, params: dict = None) -> int:
+        with metrics.timer("db_query_seconds", kind="commit"):
+            async with self.engine.connect() as conn:
+                async with conn.begin():
+                    try:
+                        result = await conn.execute(query, params)
+                    except IntegrityError as e:
+                        raise Exception(f"IntegrityError: {e}")
+                    else:
+                        return result.rowcount
 
 
-    async def _fetch(self, query) -> pd.DataFrame:
-        with self.engine.connect() as conn:
-            with conn.begin():
-                try:
-                    result = conn.execute(text(query))
-                    data = result.fetchall()
-                except Exception as e:
-                    conn.rollback()
-                    raise Exception(f"Error: {e}")
-        data = pd.DataFrame(data, columns=result.keys())
-        data = await self._format_response(data)
+    async def _fetch(self, query, params: dict = None) -> pd.DataFrame:
+        with metrics.timer("db_query_seconds", kind="fetch"):
+            async with self.engine.connect() as conn:
+                async with conn.begin():
+                    try:
+                        result = await conn.execute(query, params)
+                        data = result.fetchall()
+                    except Exception as e:
+                        raise Exception(f"Error: {e}")
+        with metrics.timer("db_format_seconds"):
+            data = pd.DataFrame(data, columns=list(result.keys()))
+            data = await self._format_response(data)
         return data
 
 
-    async def query(self, query):
+    async def query(self, query, params: dict = None, expanding: list[str] = None):
+        # expanding: "IN :name" に渡すリストのパラメータ名 (要素の数だけバインド変数に展開する)
+        # params に辞書のリストを渡した場合は、行ごとに実行する (executemany)
+        statement = text(query)
+        if expanding:
+            statement = statement.bindparams(*[bindparam(name, expanding=True) for name in expanding])
         if "SELECT" in query:
-            return await self._fetch(query)
+            return await self._fetch(statement, params)
         else:
-            return await self._commit(query)
\ No newline at end of file
+            return await self._commit(statement, params)
+
+
+    async def bulk_upsert(self,
+                          table: str,
+                          columns: list[str],
+                          rows: list[dict],
+                          key_column: str = "id",
+                          update_expressions: dict = None,
+                          batch_size: int = 500,
+                          hash_column: str = None) -> dict:
+        # INSERT ... ON DUPLICATE KEY UPDATE をバインド変数で一括実行する (全バッチで1トランザクション)
+        # hash_column を指定した場合は、保存済みのハッシュと同じ行を送らずに「変更なし」として数える
+        result = {"inserted": 0, "updated": 0, "unchanged": 0}
+        if not rows:
+            return result
+
+        update_expressions = update_expressions or {}
+        update_sql = ", ".join([
+            f"{column} = {update_expressions.get(column, f'VALUES({column})')}"
+            for column in columns if column != key_column])
+        insert_query = text(
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join([f':{column}' for column in columns])}) "
+            f"ON DUPLICATE KEY UPDATE {update_sql}")
+        exists_query = text(
+            f"SELECT {key_column}, {hash_column or 'NULL'} FROM {table} WHERE {key_column} IN :keys"
+        ).bindparams(bindparam("keys", expanding=True))
+
+        async with self.engine.connect() as conn:
+            async with conn.begin():
+                try:
+                    for i in range(0, len(rows), batch_size):
+                        batch = rows[i:i + batch_size]
+                        with metrics.timer("db_query_seconds", kind="bulk_upsert"):
+                            existing = dict((await conn.execute(
+                                exists_query, {"keys": [row[key_column] for row in batch]})).fetchall())
+                            if hash_column:
+                                changed = [row for row in batch
+                                           if row[key_column] not in existing or existing[row[key_column]] != row[hash_column]]
+                            else:
+                                changed = batch
+                            affected = (await conn.execute(insert_query, changed)).rowcount if changed else 0
+
+                        # 影響行数は 追加: 1, 更新: 2, 変更なし: 0
+                        inserted = len(batch) - len(existing)
+                        updated = (affected - inserted) // 2
+                        result["inserted"] += inserted
+                        result["updated"] += updated
+                        result["unchanged"] += len(existing) - updated
+                except IntegrityError as e:
+                    raise Exception(f"IntegrityError: {e}")
+
+        metrics.inc("db_rows_upserted_total", result["inserted"] + result["updated"], table=table)
+        return result
+
+
+    async def bulk_insert(self,
+                          table: str,
+                          columns: list[str],
+                          rows: list[dict],
+                          batch_size: int = 1000,
+                          key_columns: list[str] = None) -> int:
+        # 追記専用のテーブル向けに INSERT をバインド変数で一括実行する
+        # key_columns を指定した場合は、同じキーの行が既にあれば新しい値で上書きする (複数のワーカーが同時に書き込む場合)
+        if not rows:
+            return 0
+        query = (f"INSERT INTO {table} ({', '.join(columns)}) "
+                 f"VALUES ({', '.join([f':{column}' for column in columns])})")
+        if key_columns:
+            query += " ON DUPLICATE KEY UPDATE " + ", ".join(
+                [f"{column} = VALUES({column})" for column in columns if column not in key_columns])
+        insert_query = text(query)
+        inserted = 0
+        with metrics.timer("db_query_seconds", kind="bulk_insert"):
+            async with self.engine.connect() as conn:
+                async with conn.begin():
+                    try:
+                        for i in range(0, len(rows), batch_size):
+                            inserted += (await conn.execute(insert_query, rows[i:i + batch_size])).rowcount
+                    except IntegrityError as e:
+                        raise Exception(f"IntegrityError: {e}")
+        return inserted
\ No newline at end of file
@@ -0,0 +1,163 @@
+import json
+import hashlib
+import datetime
+from functools import lru_cache
+
+import pandas as pd
+
+
+SEPARATOR = "#" * 20
+# クレジットは動画ごとの取得元チャンネル名で作る (チャンネル名がない古い行は最初のチャンネル)
+CREDIT = "この動画は「{channelTitle}」さんの公式チャンネルから取得したアーカイブ動画です。"
+DEFAULT_CHANNEL_TITLE = "Aqua Ch. 湊あくあ"
+DATETIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+TYPE_HEADERS = {
+    "shorts": "【#Shorts】\n",
+    "liveArchive": "【配信アーカイブ または プレミア公開 動画】\n",
+    "video": "【通常動画】\n"
+}
+
+# 説明文を組み立てるのに使うカラム (これ以外の値は結果に影響しない)
+FIELDS = ("title", "videoType", "description", "publishedAt",
+          "liveStreamingDetails_scheduledStartTime", "liveStreamingDetails_actualStartTime",
+          "liveStreamingDetails_actualEndTime", "viewCount", "likeCount", "commentCount", "channelTitle")
+
+# テンプレートは1回だけ組み立てておく
+TEMPLATE = (
+    f"{SEPARATOR}\n\n"
+    "{header}"
+    "{live}"
+    "投稿日時: {publishedAt}\n"
+    "再生回数: {viewCount}\n"
+    "高評価数: {likeCount}\n"
+    "コメント数: {commentCount}\n"
+    "※ データは取得時点({fetchedAt})のものです。\n\n"
+    f"{CREDIT}"
+    f"\n\n{SEPARATOR}\n\n\n\n"
+    "{description}"
+)
+LIVE_TEMPLATE = (
+    "配信・公開予定日時: {scheduledStartTime}\n"
+    "配信・公開開始日時: {actualStartTime}\n"
+    "配信・公開終了日時: {actualEndTime}\n"
+)
+
+
+def format_video_info(video_data: dict, fetched_at: datetime.datetime = None) -> tuple[str, str]:
+    # 1本分のタイトルと説明文 (同じ内容・同じ取得日時なら前回の結果を返す)
+    fetched_at = format_fetched_at(fetched_at)
+    values = tuple(normalize(video_data.get(field)) for field in FIELDS)
+    return _format_video_info(values, fetched_at)
+
+
+@lru_cache(maxsize=4096)
+def _format_video_info(values: tuple, fetched_at: str) -> tuple[str, str]:
+    video = dict(zip(FIELDS, values))
+    video_type = video["videoType"]
+    if video_type not in TYPE_HEADERS:
+        raise ValueError("Error: videoType is invalid.")
+
+    title = video["title"] + ("  #Shorts" if video_type == "shorts" else "")
+    live = ""
+    if video_type == "liveArchive":
+        scheduled = video["liveStreamingDetails_scheduledStartTime"]
+        live = LIVE_TEMPLATE.format(
+            scheduledStartTime=format_datetime(scheduled) if scheduled is not None else "[指定なし]",
+            actualStartTime=format_datetime(video["liveStreamingDetails_actualStartTime"]),
+            actualEndTime=format_datetime(video["liveStreamingDetails_actualEndTime"]))
+
+    description = TEMPLATE.format(
+        header=TYPE_HEADERS[video_type],
+        live=live,
+        publishedAt=format_datetime(video["publishedAt"]),
+        viewCount=f"{insert_comma(video['viewCount'])} 回" if video["viewCount"] is not None else "[非公開]",
+        likeCount=f"{insert_comma(video['likeCount'])} 件" if video["likeCount"] is not None else "[非公開]",
+        commentCount=f"{insert_comma(video['commentCount'])} 件" if video["commentCount"] is not None else "[コメント無効]",
+        fetchedAt=fetched_at,
+        channelTitle=video["channelTitle"] or DEFAULT_CHANNEL_TITLE,
+        description=video["description"])
+
+    return title.replace("u3000", "　"), description.replace("u3000", "　")
+
+
+def format_video_info_batch(videos: pd.DataFrame, fetched_at: datetime.datetime = None) -> pd.DataFrame:
+    # DataFrame 全体をカラム単位でまとめて変換する (戻り値は title, description の2カラム)
+    if videos.empty:
+        return pd.DataFrame({"title": pd.Series(dtype=object), "description": pd.Series(dtype=object)}, index=videos.index)
+
+    video_type = videos["videoType"]
+    # format_video_info と同じく、空文字もチャンネル名がないものとして扱う
+    channel_title = (videos["channelTitle"].replace("", pd.NA).fillna(DEFAULT_CHANNEL_TITLE).astype(str)
+                     if "channelTitle" in videos else DEFAULT_CHANNEL_TITLE)
+    credit_prefix, credit_suffix = CREDIT.split("{channelTitle}")
+    if not video_type.isin(list(TYPE_HEADERS)).all():
+        raise ValueError("Error: videoType is invalid.")
+    is_shorts = video_type == "shorts"
+    is_live = video_type == "liveArchive"
+
+    scheduled = format_datetime_column(videos["liveStreamingDetails_scheduledStartTime"], "[指定なし]")
+    live = ("配信・公開予定日時: " + scheduled
+            + "\n配信・公開開始日時: " + format_datetime_column(videos["liveStreamingDetails_actualStartTime"])
+            + "\n配信・公開終了日時: " + format_datetime_column(videos["liveStreamingDetails_actualEndTime"]) + "\n")
+    live = live.where(is_live, "")
+
+    description = (
+        f"{SEPARATOR}\n\n"
+        + video_type.map(TYPE_HEADERS)
+        + live
+        + "投稿日時: " + format_datetime_column(videos["publishedAt"]) + "\n"
+        + "再生回数: " + format_count_column(videos["viewCount"], " 回", "[非公開]") + "\n"
+        + "高評価数: " + format_count_column(videos["likeCount"], " 件", "[非公開]") + "\n"
+        + "コメント数: " + format_count_column(videos["commentCount"], " 件", "[コメント無効]") + "\n"
+        + f"※ データは取得時点({format_fetched_at(fetched_at)})のものです。\n\n{credit_prefix}"
+        + channel_title + f"{credit_suffix}\n\n{SEPARATOR}\n\n\n\n"
+        + videos["description"].fillna("None").astype(str)
+    )
+    title = videos["title"].astype(str) + pd.Series("  #Shorts", index=videos.index).where(is_shorts, "")
+
+    return pd.DataFrame({
+        "title": title.str.replace("u3000", "　", regex=False),
+        "description": description.str.replace("u3000", "　", regex=False)
+    }, index=videos.index)
+
+
+def push_hash(title: str, description: str, tags: list[str], fetched_at: datetime.datetime) -> str:
+    # 最後にYouTubeへ送った内容のハッシュ (取得日時は毎回変わるので除く)
+    description = description.replace(f"取得時点({format_fetched_at(fetched_at)})", "取得時点()")
+    return hashlib.sha256(json.dumps([title, description, list(tags or [])], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def format_datetime_column(values: pd.Series, missing: str = "[非公開]") -> pd.Series:
+    return pd.to_datetime(values, errors="coerce").dt.strftime(DATETIME_FORMAT).fillna(missing)
+
+
+def format_count_column(values: pd.Series, unit: str, missing: str) -> pd.Series:
+    numbers = pd.to_numeric(values, errors="coerce")
+    formatted = numbers.dropna().astype("int64").map("{:,}".format).astype(object) + unit
+    return formatted.reindex(values.index, fill_value=missing)
+
+
+def format_fetched_at(fetched_at: datetime.datetime = None) -> str:
+    return (fetched_at or datetime.datetime.now()).strftime(DATETIME_FORMAT)
+
+
+def normalize(value):
+    # NaN / NaT は None として扱う (キャッシュのキーにも使うため)
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    return value
+
+
+def format_datetime(datetime_str):
+    if datetime_str is None:
+        return "[非公開]"
+    if type(datetime_str) == str:
+        return datetime.datetime.strptime(datetime_str, "%Y-%m-%d %H:%M:%S").strftime(DATETIME_FORMAT)
+    else:
+        return datetime_str.strftime(DATETIME_FORMAT)
+
+
+def insert_comma(text: str) -> str:
+    # 3文字ごとにカンマを挿入
+    text = int(text)
+    return str("{:,}".format(text))
@@ -0,0 +1,145 @@
+import hmac
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from modules.metrics import metrics
+
+
+HUB_URL = "https://pubsubhubbub.appspot.com/subscribe"
+NAMESPACES = {
+    "atom": "http://www.w3.org/2005/Atom",
+    "yt": "http://www.youtube.com/xml/schemas/2015"
+}
+
+
+def topic_url(channel_id: str) -> str:
+    return f"https://www.youtube.com/xml/feeds/videos.xml?channel_id={channel_id}"
+
+
+def subscribe(channel_id: str, callback_url: str, secret: str = None, lease_seconds: int = 60*60*24*5, hub_url: str = HUB_URL) -> bool:
+    # ハブに購読を依頼する (確認のリクエストが callback_url に届いてから有効になる)
+    data = {
+        "hub.mode": "subscribe",
+        "hub.topic": topic_url(channel_id),
+        "hub.callback": callback_url,
+        "hub.verify": "async",
+        "hub.lease_seconds": str(lease_seconds)
+    }
+    if secret:
+        data["hub.secret"] = secret
+    try:
+        response = requests.post(hub_url, data=data, timeout=10)
+    except requests.RequestException as e:
+        print(f"Failed to subscribe to the feed: {e}")
+        return False
+    if response.status_code not in (202, 204):
+        print(f"Failed to subscribe to the feed: {response.status_code} {response.text[:200]}")
+        return False
+    return True
+
+
+def parse_notification(body: bytes) -> list[tuple[str, str]]:
+    # Atom フィードから (動画ID, チャンネルID) を取り出す (削除通知は含まれない)
+    try:
+        root = ET.fromstring(body)
+    except ET.ParseError:
+        return []
+    items = []
+    for entry in root.findall("atom:entry", NAMESPACES):
+        video_id = entry.findtext("yt:videoId", namespaces=NAMESPACES)
+        channel_id = entry.findtext("yt:channelId", namespaces=NAMESPACES)
+        if video_id:
+            items.append((video_id, channel_id))
+    return items
+
+
+class FeedServer:
+    def __init__(self,
+                 port: int,
+                 on_notify,
+                 channel_ids: list[str] = None,
+                 secret: str = None,
+                 host: str = "127.0.0.1"):
+        # PubSubHubbub の通知を受け取り、on_notify(動画IDのリスト) を呼ぶ
+        # channel_ids を指定した場合は、それ以外のチャンネルの購読確認・通知を無視する
+        self.port = port
+        self.host = host
+        self.on_notify = on_notify
+        self.topics = {topic_url(channel_id) for channel_id in channel_ids} if channel_ids else None
+        self.channel_ids = set(channel_ids) if channel_ids else None
+        self.secret = secret
+        self._server = None
+
+
+    def verify_signature(self, body: bytes, signature: str) -> bool:
+        if not self.secret:
+            return True
+        if not signature or "=" not in signature:
+            return False
+        method, digest = signature.split("=", 1)
+        if method not in ("sha1", "sha256"):
+            return False
+        expected = hmac.new(self.secret.encode("utf-8"), body, method).hexdigest()
+        return hmac.compare_digest(expected, digest)
+
+
+    def handle_notification(self, body: bytes, signature: str = None) -> list[str]:
+        if not self.verify_signature(body, signature):
+            print("Feed: invalid signature")
+            metrics.inc("feed_notifications_total", result="invalid_signature")
+            return []
+        video_ids = [video_id for video_id, channel_id in parse_notification(body)
+                     if self.channel_ids is None or channel_id in self.channel_ids]
+        metrics.inc("feed_notifications_total", result="accepted" if video_ids else "ignored")
+        if video_ids:
+            self.on_notify(video_ids)
+        return video_ids
+
+
+    def start(self) -> None:
+        feed = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                # 購読の確認 (hub.challenge をそのまま返す)
+                params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                challenge = params.get("hub.challenge")
+                if challenge is None or (feed.topics is not None and params.get("hub.topic") not in feed.topics):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                print(f"Feed: {params.get('hub.mode')} {params.get('hub.topic')}")
+                body = challenge.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                # 署名が不正な場合もハブに再送させないように 2xx を返す
+                self.send_response(204)
+                self.end_headers()
+                try:
+                    feed.handle_notification(body, self.headers.get("X-Hub-Signature"))
+                except Exception as e:
+                    print(f"Feed: failed to handle the notification: {e}")
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="feed-server", daemon=True).start()
+        print(f"Feed: http://{self.host}:{self.port}/")
+
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
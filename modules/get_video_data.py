@@ -1,7 +1,6 @@
 import os
 import json
 import time
-import asyncio
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv, find_dotenv
@@ -119,43 +118,16 @@ class GetVideoData:
         print(f"動画データを取得しました：{len(video_items)}本")
         self.get_video_type(video_items)
         json_save(video_items, os.path.join(self.target_dir, "videos.json"))
-        asyncio.run(save_to_database(video_items))
+        db.run(save_to_database(video_items))
 
 
 async def save_to_database(json_data):
-    chunks_data = list(chunks(json_data, 30))
-    for chunk in chunks_data:
-        rows = []
-        for video in chunk:
-            columns = into_str(video)
-            rows.append(str(tuple(columns)).replace("None", "NULL"))
-
-        query = f"""
-            INSERT INTO TargetVideo
-                (id, videoType, title, description, publishedAt,
-                liveStreamingDetails_scheduledStartTime, liveStreamingDetails_actualStartTime,
-                liveStreamingDetails_actualEndTime, categoryId, tags, thumbnails_url,
-                commentCount, likeCount, viewCount)
-            VALUES
-                {",".join(rows)}
-            ON DUPLICATE KEY
-            UPDATE
-                videoType = VALUES(videoType),
-                title = VALUES(title),
-                description = VALUES(description),
-                publishedAt = VALUES(publishedAt),
-                liveStreamingDetails_scheduledStartTime = VALUES(liveStreamingDetails_scheduledStartTime),
-                liveStreamingDetails_actualStartTime = VALUES(liveStreamingDetails_actualStartTime),
-                liveStreamingDetails_actualEndTime = VALUES(liveStreamingDetails_actualEndTime),
-                categoryId = VALUES(categoryId),
-                tags = VALUES(tags),
-                thumbnails_url = VALUES(thumbnails_url),
-                commentCount = VALUES(commentCount),
-                likeCount = VALUES(likeCount),
-                viewCount = VALUES(viewCount);
-            """
-
-        await db.query(query.replace("Ninomae Ina'nis", "Ninomae Ina’nis"))
+    columns = ["id", "videoType", "title", "description", "publishedAt",
+               "liveStreamingDetails_scheduledStartTime", "liveStreamingDetails_actualStartTime",
+               "liveStreamingDetails_actualEndTime", "categoryId", "tags", "thumbnails_url",
+               "commentCount", "likeCount", "viewCount"]
+    rows = [dict(zip(columns, into_str(video))) for video in json_data]
+    return await db.bulk_upsert("TargetVideo", columns, rows)
 
 
 def json_save(data, filename):
@@ -205,8 +177,8 @@ def into_str(video):
 
     columns.append(video["snippet"]["categoryId"]
                    if "categoryId" in video["snippet"] else None)
-    columns.append("[" + ",".join([f"'{tag}'" for tag in video["snippet"]
-                   ["tags"]]) + "]" if "tags" in video["snippet"] else None)
+    columns.append(json.dumps(video["snippet"]["tags"], ensure_ascii=False)
+                   if "tags" in video["snippet"] else None)
 
     thumbnails = video["snippet"]["thumbnails"]
     if "maxres" in thumbnails:
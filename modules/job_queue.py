@@ -0,0 +1,228 @@
+import os
+import socket
+import uuid
+import threading
+from collections import deque
+
+import pandas as pd
+
+from modules.db import DBManager
+
+
+# 配信予定 (開始前) または配信中 (終了日時がまだない) の動画
+UNFINISHED_LIVE = ("liveStreamingDetails_actualEndTime IS NULL"
+                   " AND (liveStreamingDetails_scheduledStartTime IS NOT NULL"
+                   " OR liveStreamingDetails_actualStartTime IS NOT NULL)")
+# 取得できる動画の条件 (アップロード済み・失敗の上限に達した・再試行の待ち時間中の動画を除く)
+# 配信予定・配信中の動画も、同期で終了日時が記録されるまでは取得しない (途中からの録画になるため)
+CLAIMABLE = ("isPushed = 0 AND failedAttempts < :maxAttempts"
+             " AND (nextAttemptAt IS NULL OR nextAttemptAt < NOW())"
+             f" AND NOT ({UNFINISHED_LIVE})")
+
+
+class TargetVideoQueue:
+    def __init__(self,
+                 db: DBManager,
+                 worker_id: str = None,
+                 lease_seconds: int = 60*30,
+                 channel_weights: dict = None,
+                 max_attempts: int = 5,
+                 retry_seconds: int = 60*30):
+        # 複数のワーカーが同じ動画を処理しないように、行ごとに期限付きのリースを取る
+        # channel_weights: チャンネルID -> 重み (claim_next で重みに応じた割合でチャンネルを選ぶ)
+        # 失敗した動画は retry_seconds から倍々に間隔を空けて、max_attempts 回まで取り直す
+        self.db = db
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.channels = StrideScheduler(channel_weights)
+        self.claimed = set()
+        self._lock = threading.Lock()
+        self._heartbeat_stop = None
+
+
+    async def claim(self, limit: int = 1, downloaded: bool = False, ids: list[str] = None, channel_id: str = None) -> pd.DataFrame:
+        params = {"owner": self.worker_id, "lease": self.lease_seconds, "downloaded": int(downloaded),
+                  "maxAttempts": self.max_attempts}
+        condition = f"isDownloaded = :downloaded AND {CLAIMABLE} AND (leaseOwner IS NULL OR leaseExpiresAt < NOW())"
+        if channel_id is not None:
+            params["channelId"] = channel_id
+            condition += " AND channelId = :channelId"
+        expanding = None
+        if ids is not None:
+            if not ids:
+                return pd.DataFrame()
+            params["ids"] = list(ids)
+            expanding = ["ids"]
+            condition += " AND id IN :ids"
+
+        # UPDATE ... ORDER BY ... LIMIT は1文で実行されるので、他のワーカーと取り合いにならない
+        await self.db.query(f"""
+            UPDATE TargetVideo
+            SET leaseOwner = :owner, leaseExpiresAt = NOW() + INTERVAL :lease SECOND
+            WHERE {condition}
+            ORDER BY publishedAt ASC
+            LIMIT {int(limit)};
+            """, params, expanding=expanding)
+        videos = await self.db.query(
+            "SELECT * FROM TargetVideo WHERE leaseOwner = :owner AND isDownloaded = :downloaded AND isPushed = 0 ORDER BY publishedAt ASC;",
+            params)
+
+        with self._lock:
+            if not videos.empty:
+                videos = videos[~videos["id"].isin(self.claimed)].reset_index(drop=True)
+            self.claimed.update(videos["id"] if not videos.empty else [])
+        return videos
+
+
+    async def claim_next(self, downloaded: bool = False) -> pd.DataFrame:
+        # 処理が遅れているチャンネルから1本取る (1本ごとに 1 / 重み だけ進める)
+        if len(self.channels.weights) <= 1:
+            return await self.claim(1, downloaded)
+        with self._lock:
+            order = self.channels.order(self.channels.weights)
+        for channel_id in order:
+            videos = await self.claim(1, downloaded, channel_id=channel_id)
+            if not videos.empty:
+                with self._lock:
+                    self.channels.charge(channel_id)
+                return videos
+        return pd.DataFrame()
+
+
+    async def pending_count(self, downloaded: bool = False) -> int:
+        # 取得できる (失敗の上限・再試行の待ち時間に当たらない) 動画の本数
+        data = await self.db.query(
+            f"SELECT COUNT(*) AS count FROM TargetVideo WHERE isDownloaded = :downloaded AND {CLAIMABLE};",
+            {"downloaded": int(downloaded), "maxAttempts": self.max_attempts})
+        return int(data["count"].iloc[0])
+
+
+    async def fail(self, video_id: str, error: str) -> None:
+        # 失敗を記録してリースを外す (SET は左から順に評価されるので failedAttempts は加算後の値)
+        await self.db.query("""
+            UPDATE TargetVideo
+            SET failedAttempts = failedAttempts + 1,
+                nextAttemptAt = NOW() + INTERVAL LEAST(:retry * POW(2, failedAttempts - 1), 60*60*24) SECOND,
+                lastError = :error,
+                leaseOwner = NULL, leaseExpiresAt = NULL
+            WHERE id = :id AND leaseOwner = :owner;
+            """, {"id": video_id, "owner": self.worker_id, "retry": self.retry_seconds, "error": error[:1000]})
+        with self._lock:
+            self.claimed.discard(video_id)
+
+
+    async def heartbeat(self) -> None:
+        await self.db.query(
+            "UPDATE TargetVideo SET leaseExpiresAt = NOW() + INTERVAL :lease SECOND WHERE leaseOwner = :owner;",
+            {"owner": self.worker_id, "lease": self.lease_seconds})
+
+
+    async def release(self, video_id: str) -> None:
+        await self.db.query(
+            "UPDATE TargetVideo SET leaseOwner = NULL, leaseExpiresAt = NULL WHERE id = :id AND leaseOwner = :owner;",
+            {"id": video_id, "owner": self.worker_id})
+        with self._lock:
+            self.claimed.discard(video_id)
+
+
+    async def release_all(self) -> None:
+        await self.db.query(
+            "UPDATE TargetVideo SET leaseOwner = NULL, leaseExpiresAt = NULL WHERE leaseOwner = :owner;",
+            {"owner": self.worker_id})
+        with self._lock:
+            self.claimed.clear()
+
+
+    def start_heartbeat(self, interval: float = None) -> None:
+        # ダウンロード・アップロードに時間がかかってもリースが切れないように延長し続ける
+        if self._heartbeat_stop is not None:
+            return
+        interval = interval or self.lease_seconds / 3
+        self._heartbeat_stop = threading.Event()
+
+        def loop(stop_event: threading.Event):
+            while not stop_event.wait(interval):
+                try:
+                    self.db.run(self.heartbeat())
+                except Exception as e:
+                    print(f"Failed to extend lease: {e}")
+
+        threading.Thread(target=loop, args=(self._heartbeat_stop,), daemon=True).start()
+
+
+    def stop_heartbeat(self) -> None:
+        if self._heartbeat_stop is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_stop = None
+
+
+class StrideScheduler:
+    def __init__(self, weights: dict = None):
+        # 重み付き公平スケジューリング (stride scheduling)
+        # 1回処理するごとに 1 / 重み だけ進み、最も遅れているものから処理する
+        self.weights = dict(weights or {})
+        self.passes = {}
+        # 最後に処理したものの開始位置 (しばらく処理待ちがなかったものが溜めた分を一度に使わないようにする)
+        self.virtual_time = 0.0
+
+
+    def _start(self, key) -> float:
+        return max(self.passes.get(key, 0.0), self.virtual_time)
+
+
+    def order(self, keys) -> list:
+        return sorted(keys, key=lambda key: (self._start(key), str(key)))
+
+
+    def charge(self, key, cost: float = 1.0) -> None:
+        start = self._start(key)
+        self.virtual_time = start
+        self.passes[key] = start + cost / self.weights.get(key, 1.0)
+
+
+class WeightedFairQueue:
+    def __init__(self, weights: dict = None):
+        # キーごとのキューから重みに応じた割合で取り出す (キーを指定しない場合は None のキュー)
+        self.scheduler = StrideScheduler(weights)
+        self._queues = {}
+        self._condition = threading.Condition()
+        self._closed = False
+
+
+    def put(self, item, key=None, front: bool = False) -> None:
+        # front: 取り出した要素を戻す場合 (先頭に戻し、取り出した分を取り消す)
+        with self._condition:
+            items = self._queues.setdefault(key, deque())
+            if front:
+                items.appendleft(item)
+                self.scheduler.passes[key] = self.scheduler.passes.get(key, 0.0) - 1 / self.scheduler.weights.get(key, 1.0)
+            else:
+                items.append(item)
+            self._condition.notify()
+
+
+    def get(self):
+        # close 後にキューが空になった場合は None を返す
+        with self._condition:
+            while True:
+                keys = [key for key, items in self._queues.items() if items]
+                if keys:
+                    key = self.scheduler.order(keys)[0]
+                    self.scheduler.charge(key)
+                    return self._queues[key].popleft()
+                if self._closed:
+                    return None
+                self._condition.wait()
+
+
+    def qsize(self) -> int:
+        with self._condition:
+            return sum(len(items) for items in self._queues.values())
+
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    def __init__(self):
+        # counters: 累積値 (クォータ消費量など), summaries: 観測値の件数・合計・最大 (所要時間・バイト数)
+        # キーは (メトリクス名, ラベルのタプル)
+        self.counters = {}
+        self.summaries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._server = None
+
+
+    def configure(self, jsonl_path: str = None, port: int = None) -> None:
+        # jsonl_path: 観測ごとに1行追記するファイル, port: Prometheus形式で /metrics を返すポート
+        if jsonl_path:
+            os.makedirs(os.path.dirname(jsonl_path) or ".", exist_ok=True)
+            with self._lock:
+                # 途中で強制終了しても失われないように1行ずつ書き出す
+                self._file = open(jsonl_path, "a", encoding="utf-8", buffering=1)
+        if port:
+            self.start_http_server(port)
+
+
+    def inc(self, metric: str, value: float = 1, **labels) -> None:
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._write({"type": "counter", "name": metric, "labels": labels, "value": value})
+
+
+    def observe(self, metric: str, value: float, **labels) -> None:
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            count, total, maximum = self.summaries.get(key, (0, 0.0, 0.0))
+            self.summaries[key] = (count + 1, total + value, max(maximum, value))
+        self._write({"type": "summary", "name": metric, "labels": labels, "value": value})
+
+
+    @contextmanager
+    def timer(self, metric: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.perf_counter() - start, **labels)
+
+
+    def record_stage(self, stage: str, seconds: float, size: int = None, **labels) -> None:
+        # ダウンロード・アップロードなどの段階ごとの所要時間と転送量
+        self.observe("stage_duration_seconds", seconds, stage=stage, **labels)
+        if size is not None:
+            self.observe("stage_bytes", size, stage=stage, **labels)
+            if seconds > 0:
+                self.observe("stage_mb_per_second", size / 1024**2 / seconds, stage=stage, **labels)
+
+
+    def _write(self, record: dict) -> None:
+        if self._file is None:
+            return
+        line = json.dumps(dict(record, time=datetime.now().isoformat()), ensure_ascii=False)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            counters = dict(self.counters)
+            summaries = dict(self.summaries)
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (count, total, maximum) in sorted(summaries.items()):
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_max{format_labels(labels)} {maximum}")
+        return "\n".join(lines) + "\n"
+
+
+    def start_http_server(self, port: int, host: str = "127.0.0.1") -> None:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        print(f"Metrics: http://{host}:{port}/metrics")
+
+
+    def close(self) -> None:
+        # os._exit で終了する場合は atexit が動かないので明示的に呼ぶ
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join([f'{key}="{escape_label(value)}"' for key, value in labels]) + "}"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# プロセス全体で共有する
+metrics = Metrics()
@@ -0,0 +1,146 @@
+import time
+import queue
+import threading
+
+import requests
+
+
+class WebhookNotifier:
+    def __init__(self,
+                 webhook_url: str,
+                 batch_interval: float = 2.0,
+                 max_length: int = 2000,
+                 max_retries: int = 3):
+        # 通知はキューに積むだけにして、送信は専用スレッドでまとめて行う (処理を待たせない)
+        self.webhook_url = webhook_url
+        self.batch_interval = batch_interval
+        # Discord の content の上限
+        self.max_length = max_length
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._thread = None
+        if webhook_url:
+            self._thread = threading.Thread(target=self._worker, name="WebhookNotifier", daemon=True)
+            self._thread.start()
+
+
+    def post(self, message: str, key: str = None) -> None:
+        # key を指定した通知は、まだ送っていない同じ key の通知を置き換える (進捗表示など)
+        if self._thread is None:
+            return
+        with self._idle:
+            self._pending += 1
+        self._queue.put((key, message))
+
+
+    def flush(self, timeout: float = 10) -> bool:
+        # キューに残っている通知を送り終えるまで待つ
+        deadline = time.time() + timeout
+        with self._idle:
+            while self._pending > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+
+    def close(self, timeout: float = 10) -> None:
+        # os._exit で終了する場合は atexit が動かないので明示的に呼ぶ
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._queue.put(None)
+        self._thread.join(1)
+        self._thread = None
+        self.session.close()
+
+
+    def _collect(self, first) -> tuple[list[str], int, bool]:
+        # 最初の通知から batch_interval の間に届いたものをまとめる
+        batch = {}
+        count = 0
+        stop = False
+        deadline = time.time() + self.batch_interval
+        item = first
+        while True:
+            if item is None:
+                stop = True
+                break
+            key, message = item
+            count += 1
+            if key is not None:
+                # 置き換えた通知は元の位置から外して末尾に移す
+                batch.pop(("key", key), None)
+                batch[("key", key)] = message
+            else:
+                batch[("message", count)] = message
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        return list(batch.values()), count, stop
+
+
+    def _split(self, messages: list[str]) -> list[str]:
+        contents = []
+        content = ""
+        for message in messages:
+            message = message.strip("\n")[:self.max_length]
+            if content and len(content) + len(message) + 1 > self.max_length:
+                contents.append(content)
+                content = ""
+            content = f"{content}\n{message}" if content else message
+        if content:
+            contents.append(content)
+        return contents
+
+
+    def _send(self, content: str) -> None:
+        for retry in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.webhook_url, json={"content": content}, timeout=10)
+            except requests.RequestException as e:
+                print(f"Failed to send log to Discord: {e}")
+                time.sleep(2 ** retry)
+                continue
+
+            if response.status_code == 429:
+                # レート制限中は指定された時間だけ待ってから送り直す
+                retry_after = response.headers.get("Retry-After")
+                try:
+                    retry_after = float(retry_after) if retry_after else float(response.json().get("retry_after", 1))
+                except ValueError:
+                    retry_after = 1
+                response.close()
+                time.sleep(retry_after)
+                continue
+            if response.status_code >= 500:
+                response.close()
+                time.sleep(2 ** retry)
+                continue
+            if response.status_code >= 400:
+                print(f"Failed to send log to Discord: {response.status_code} {response.text[:200]}")
+            response.close()
+            return
+        print("Failed to send log to Discord: retry limit exceeded")
+
+
+    def _worker(self):
+        while True:
+            first = self._queue.get()
+            messages, count, stop = self._collect(first)
+            for content in self._split(messages):
+                self._send(content)
+            with self._idle:
+                self._pending -= count
+                self._idle.notify_all()
+            if stop:
+                return
@@ -0,0 +1,190 @@
+import threading
+from datetime import datetime, timedelta
+
+from modules.db import DBManager
+from modules.metrics import metrics
+
+
+QUOTA_LIMIT: int = 210000
+# QuotaData をリセットする時刻 (YouTube Data API のリセットは太平洋時間の0時)
+QUOTA_RESET_TIME: str = "16:00"
+
+
+def seconds_until_reset(now: datetime = None) -> float:
+    now = now or datetime.now()
+    hour, minute = map(int, QUOTA_RESET_TIME.split(":"))
+    reset_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if reset_at <= now:
+        reset_at += timedelta(days=1)
+    return (reset_at - now).total_seconds()
+
+
+class QuotaLedger:
+    def __init__(self,
+                 db: DBManager,
+                 block_size: int = 100,
+                 flush_interval: float = 60*5,
+                 limit: int = QUOTA_LIMIT):
+        # QuotaData からまとめてユニットを確保し、API呼び出しごとの消費は手元で数える
+        self.db = db
+        self.block_size = block_size
+        self.limit = limit
+        self.balance = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._released = threading.Condition()
+        # アカウント名 -> クォータ待ちのスレッド数 (アカウントを指定せずに待つ場合は None)
+        self._waiting = {}
+        # クォータ待ちに入ったときに呼ぶ関数 (先読みを止めずに続けるため)
+        self._waiting_listeners = []
+
+        if flush_interval:
+            self._flush_stop = threading.Event()
+            threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True).start()
+
+
+    def _lock(self, name: str) -> threading.Lock:
+        with self._locks_lock:
+            if name not in self._locks:
+                self._locks[name] = threading.Lock()
+            return self._locks[name]
+
+
+    async def _reserve(self, name: str, units: int) -> bool:
+        # 確認と加算を1文で行うので、他のスレッド・プロセスと同時に実行しても上限を超えない
+        rowcount = await self.db.query(
+            "UPDATE QuotaData SET quota = quota + :units WHERE name = :name AND quota + :units < :limit;",
+            {"name": name, "units": units, "limit": self.limit})
+        return rowcount == 1
+
+
+    def try_spend(self, name: str, units: int) -> bool:
+        with self._lock(name):
+            balance = self.balance.get(name, 0)
+            if balance < units:
+                needed = units - balance
+                block = max(self.block_size, needed)
+                if self.db.run(self._reserve(name, block)):
+                    balance += block
+                elif block > needed and self.db.run(self._reserve(name, needed)):
+                    # 上限間際はブロック単位では確保できないので必要な分だけ確保する
+                    balance += needed
+                else:
+                    self.balance[name] = balance
+                    return False
+            self.balance[name] = balance - units
+        metrics.inc("quota_units_spent_total", units, identity=name)
+        return True
+
+
+    def refund(self, name: str, units: int) -> None:
+        # 確保したが使わなかったユニットを手元の残高に戻す
+        with self._lock(name):
+            self.balance[name] = self.balance.get(name, 0) + units
+        metrics.inc("quota_units_refunded_total", units, identity=name)
+        self._notify()
+
+
+    def spend(self, name: str, units: int) -> None:
+        if not self.try_spend(name, units):
+            raise Exception(f"Quota exceeded: {name}")
+
+
+    async def has_quota(self, name: str, units: int) -> bool:
+        if self.balance.get(name, 0) >= units:
+            return True
+        data = await self.db.query("SELECT quota FROM QuotaData WHERE name = :name;", {"name": name})
+        return not data.empty and data.iloc[0]["quota"] + units - self.balance.get(name, 0) < self.limit
+
+
+    async def remaining(self) -> dict:
+        # アカウントごとの残りユニット (手元で確保済みの未使用分を含む)
+        data = await self.db.query("SELECT name, quota FROM QuotaData;")
+        return {name: self.limit - quota + self.balance.get(name, 0)
+                for name, quota in zip(data["name"], data["quota"])}
+
+
+    def is_waiting(self, names=None) -> bool:
+        # names を指定した場合は、そのすべてのアカウントがクォータ待ちのときだけ True
+        # (listener から呼ばれる処理のロックの中で使うので、ここではロックを取らない)
+        if names is None:
+            return any(count > 0 for count in list(self._waiting.values()))
+        return bool(names) and all(self._waiting.get(name, 0) > 0 for name in names)
+
+
+    def add_waiting_listener(self, listener) -> None:
+        self._waiting_listeners.append(listener)
+
+
+    def remove_waiting_listener(self, listener) -> None:
+        if listener in self._waiting_listeners:
+            self._waiting_listeners.remove(listener)
+
+
+    def wait_for_quota(self, name: str = None, stop_event: threading.Event = None) -> None:
+        # 次のリセットまで、またはこのプロセス内でクォータが戻されるまで待つ
+        # 外部からリセットされた場合に備えて、リセット時刻より少し後に起きる
+        # name: クォータを待っているアカウント (is_waiting で使う)
+        # stop_event: セットしてから wake_all を呼ぶと、リセットを待たずに戻る
+        timeout = seconds_until_reset() + 30
+        print(f"\rNo quota left. Waiting for the next reset in {timeout / 60:.0f} minutes.  {datetime.now()}")
+        with self._released:
+            self._waiting[name] = self._waiting.get(name, 0) + 1
+            # 待ち始めてから通知するまでの間に戻されたクォータを取りこぼさないように、ロックを持ったまま呼ぶ
+            # (listener はこのロックを取る処理を呼ばないこと)
+            for listener in list(self._waiting_listeners):
+                listener()
+            try:
+                if stop_event is None or not stop_event.is_set():
+                    self._released.wait(timeout)
+            finally:
+                self._waiting[name] -= 1
+
+
+    def wake_all(self) -> None:
+        # クォータ待ちのスレッドをすべて起こす (終了させる場合など)
+        self._notify()
+
+
+    def _notify(self) -> None:
+        with self._released:
+            self._released.notify_all()
+
+
+    def flush(self) -> None:
+        # 未使用分を QuotaData に戻し、他のプロセスから使えるようにする
+        released = False
+        for name in list(self.balance):
+            with self._lock(name):
+                units = self.balance.get(name, 0)
+                if units <= 0:
+                    continue
+                self.db.run(self.db.query(
+                    "UPDATE QuotaData SET quota = GREATEST(quota - :units, 0) WHERE name = :name;",
+                    {"name": name, "units": units}))
+                self.balance[name] = 0
+                released = True
+        if released:
+            self._notify()
+
+
+    def reset(self) -> None:
+        # クォータのリセット後は前日分として確保したユニットを戻さずに破棄する
+        for name in list(self.balance):
+            with self._lock(name):
+                self.balance[name] = 0
+        self._notify()
+
+
+    def close(self) -> None:
+        if hasattr(self, "_flush_stop"):
+            self._flush_stop.set()
+        self.flush()
+
+
+    def _flush_loop(self, interval: float):
+        while not self._flush_stop.wait(interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush quota: {e}")
@@ -0,0 +1,113 @@
+import time
+import heapq
+import itertools
+import threading
+from datetime import datetime, timedelta
+
+
+class TimerScheduler:
+    def __init__(self):
+        # 次に実行するジョブの時刻までスリープする (定期的に起きて確認しない)
+        # ヒープの要素は [実行時刻, 登録順, ジョブ名] で、ジョブ名ごとに最新の要素だけを有効とする
+        self._heap = []
+        self._jobs = {}
+        self._entries = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+
+    def every(self, seconds: float, job, name: str = None, run_now: bool = False) -> str:
+        name = name or job.__name__
+        self._jobs[name] = (job, lambda now: now + seconds)
+        self._push(name, time.time() if run_now else time.time() + seconds)
+        return name
+
+
+    def daily_at(self, at: str, job, name: str = None) -> str:
+        # at: "HH:MM" (ローカル時刻)
+        hour, minute = map(int, at.split(":"))
+
+        def next_run(now: float) -> float:
+            current = datetime.fromtimestamp(now)
+            run_at = current.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if run_at <= current:
+                run_at += timedelta(days=1)
+            return run_at.timestamp()
+
+        name = name or job.__name__
+        self._jobs[name] = (job, next_run)
+        self._push(name, next_run(time.time()))
+        return name
+
+
+    def trigger(self, name: str, delay: float = 0) -> None:
+        # 次回の実行を前倒しする (短い間に何度呼ばれても1回にまとまる)
+        with self._condition:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] <= time.time() + delay:
+                return
+        self._push(name, time.time() + delay)
+
+
+    def _push(self, name: str, run_at: float) -> None:
+        with self._condition:
+            entry = [run_at, next(self._counter), name]
+            self._entries[name] = entry
+            heapq.heappush(self._heap, entry)
+            self._condition.notify()
+
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="TimerScheduler", daemon=True)
+        self._thread.start()
+
+
+    def stop(self, timeout: float = 10) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+    def _next_due(self):
+        # 実行時刻になったジョブ名を返す (停止した場合は None)
+        with self._condition:
+            while not self._stopped:
+                # 前倒し・再登録で古くなった要素を捨てる
+                while self._heap and self._entries.get(self._heap[0][2]) is not self._heap[0]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                remaining = self._heap[0][0] - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                entry = heapq.heappop(self._heap)
+                del self._entries[entry[2]]
+                return entry[2]
+            return None
+
+
+    def _run(self):
+        while True:
+            name = self._next_due()
+            if name is None:
+                return
+            job, next_run = self._jobs[name]
+            try:
+                job()
+            except Exception as e:
+                print(f"Scheduled job {name} failed: {e}")
+            # 実行中に前倒しされた場合はそちらを優先する
+            with self._condition:
+                if name in self._entries:
+                    continue
+            self._push(name, next_run(time.time()))
@@ -0,0 +1,198 @@
+import os
+import json
+import gzip
+import zlib
+import hashlib
+from datetime import datetime
+from typing import Iterator
+
+
+# スナップショットに保存しないキー (使っておらずサイズが大きい)
+DROP_KEYS = ("localizations",)
+
+
+def record_hash(record: dict) -> str:
+    return hashlib.sha256(json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class VideoSnapshot:
+    def __init__(self, path: str = os.path.join("data", "videos.ndjson.gz"), compact_every: int = 50):
+        # 同期ごとに新規・変更された動画だけを gzip のメンバーとして追記する
+        # 1行目は {"generation": n, ...} のマーカー、以降は1行1動画
+        self.path = path
+        self.index_path = f"{path}.index.json"
+        # 索引の変更分は1世代1行で追記し、compact_every 世代ごとに索引全体を書き直す
+        self.journal_path = f"{path}.index.log"
+        self.compact_every = compact_every
+        self._journal_entries = 0
+        # generation: 最新の世代, size: 書き込み済みのバイト数
+        # members: 世代 -> ファイル内の開始位置, records: 動画ID -> [ハッシュ, 世代]
+        self.index = {"generation": 0, "size": 0, "members": {}, "records": {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+            self._replay_journal()
+        elif os.path.exists(self.path):
+            self._rebuild_index()
+
+
+    def write(self, video_items: list[dict]) -> int:
+        # 前回から変わっていない動画は書き込まない
+        changed = []
+        for video in video_items:
+            record = {key: value for key, value in video.items() if key not in DROP_KEYS}
+            digest = record_hash(record)
+            known = self.index["records"].get(record["id"])
+            if known is None or known[0] != digest:
+                changed.append((record, digest))
+        if not changed:
+            return 0
+
+        generation = self.index["generation"] + 1
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.index["size"]:
+            # 前回の書き込み途中で止まった場合は、索引に載っていない部分を切り捨てる
+            with open(self.path, "r+b") as f:
+                f.truncate(self.index["size"])
+
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                marker = {"generation": generation, "syncedAt": datetime.now().isoformat(), "count": len(changed)}
+                gz.write((json.dumps(marker) + "\n").encode("utf-8"))
+                for record, _ in changed:
+                    gz.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            size = f.tell()
+
+        entry = {"generation": generation, "offset": offset, "size": size,
+                 "records": {record["id"]: digest for record, digest in changed}}
+        self._apply(entry)
+        if self._journal_entries + 1 >= self.compact_every:
+            self._save_index()
+        else:
+            self._append_journal(entry)
+        return len(changed)
+
+
+    def _apply(self, entry: dict) -> None:
+        generation = entry["generation"]
+        self.index["generation"] = generation
+        self.index["size"] = entry["size"]
+        self.index["members"][str(generation)] = entry["offset"]
+        for video_id, digest in entry["records"].items():
+            self.index["records"][video_id] = [digest, generation]
+
+
+    def _append_journal(self, entry: dict) -> None:
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        self._journal_entries += 1
+
+
+    def _replay_journal(self) -> None:
+        # 索引ファイルより新しい世代の変更分を反映する。書き込み途中で切れた行は捨てる
+        if not os.path.exists(self.journal_path):
+            return
+        valid = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                valid += len(line)
+                self._journal_entries += 1
+                if entry["generation"] > self.index["generation"]:
+                    self._apply(entry)
+        if valid < os.path.getsize(self.journal_path):
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(valid)
+
+
+    def iter_records(self, since_generation: int = 1) -> Iterator[tuple[int, dict]]:
+        # (世代, 動画) を書き込んだ順に返す。since_generation より前のメンバーは読み飛ばす
+        if not os.path.exists(self.path):
+            return
+        offset = self.index["members"].get(str(since_generation), 0)
+        for _, _, data in iter_members(self.path, offset, self.index["size"]):
+            lines = data.decode("utf-8").splitlines()
+            generation = json.loads(lines[0])["generation"]
+            if generation < since_generation:
+                continue
+            for line in lines[1:]:
+                yield generation, json.loads(line)
+
+
+    def iter_latest(self) -> Iterator[dict]:
+        # 動画ごとに最新の版だけを返す
+        for generation, record in self.iter_records():
+            known = self.index["records"].get(record["id"])
+            if known is not None and known[1] == generation:
+                yield record
+
+
+    def get(self, video_id: str) -> dict:
+        # 索引から世代を引いて、そのメンバーだけを読む
+        known = self.index["records"].get(video_id)
+        if known is None:
+            return None
+        generation = known[1]
+        for record_generation, record in self.iter_records(generation):
+            if record_generation != generation:
+                break
+            if record["id"] == video_id:
+                return record
+        return None
+
+
+    def _rebuild_index(self) -> None:
+        # 索引ファイルがない場合はスナップショットを1回読んで作り直す
+        members = {}
+        records = {}
+        generation = 0
+        size = 0
+        for offset, end, data in iter_members(self.path):
+            lines = data.decode("utf-8").splitlines()
+            generation = json.loads(lines[0])["generation"]
+            members[str(generation)] = offset
+            for line in lines[1:]:
+                record = json.loads(line)
+                records[record["id"]] = [record_hash(record), generation]
+            size = end
+        self.index = {"generation": generation, "size": size, "members": members, "records": records}
+        self._save_index()
+
+
+    def _save_index(self) -> None:
+        # 索引全体を書き直して変更分の記録を空にする (書き直す前に止まっても変更分から復元できる)
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_entries = 0
+
+
+def iter_members(path: str, offset: int = 0, size: int = None, chunk_size: int = 64 * 1024) -> Iterator[tuple[int, int, bytes]]:
+    # gzip のメンバーごとに (開始位置, 終了位置, 展開したデータ) を返す。途中で切れたメンバーは返さない
+    with open(path, "rb") as f:
+        while size is None or offset < size:
+            f.seek(offset)
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = []
+            consumed = 0
+            try:
+                while not decompressor.eof:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        return
+                    data.append(decompressor.decompress(chunk))
+                    consumed += len(chunk)
+            except zlib.error:
+                return
+            end = offset + consumed - len(decompressor.unused_data)
+            yield offset, end, b"".join(data)
+            offset = end
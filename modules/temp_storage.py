@@ -0,0 +1,99 @@
+import os
+import glob
+import threading
+
+
+class TempStorage:
+    def __init__(self,
+                 root: str = "temp",
+                 max_bytes: int = 50 * 1024**3):
+        # temp/videos と temp/thumbnails をまとめて管理し、合計サイズを max_bytes 以下に保つ
+        self.root = root
+        self.video_dir = os.path.join(root, "videos")
+        self.thumbnail_dir = os.path.join(root, "thumbnails")
+        self.max_bytes = max_bytes
+        # video_id -> {"state": downloading | ready | uploading, "reserved": 予約したバイト数}
+        self.files = {}
+        self._cond = threading.Condition()
+
+        os.makedirs(self.video_dir, exist_ok=True)
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+
+
+    def video_files(self, video_id: str) -> list[str]:
+        # .part やストリームごとの一時ファイルも含む
+        return (glob.glob(os.path.join(self.video_dir, f"{glob.escape(video_id)}.*"))
+                + glob.glob(os.path.join(self.thumbnail_dir, f"{glob.escape(video_id)}.*")))
+
+
+    def thumbnail_path(self, video_id: str) -> str:
+        return os.path.join(self.thumbnail_dir, f"{video_id}.jpg")
+
+
+    def size_of(self, video_id: str) -> int:
+        return sum(os.path.getsize(f) for f in self.video_files(video_id) if os.path.exists(f))
+
+
+    def used_bytes(self) -> int:
+        return sum(entry.stat().st_size
+                   for directory in (self.video_dir, self.thumbnail_dir)
+                   for entry in os.scandir(directory) if entry.is_file())
+
+
+    def _committed_bytes(self) -> int:
+        # ディスク上のサイズに、ダウンロード中の動画の残り予定サイズを足したもの
+        pending = sum(max(0, entry["reserved"] - self.size_of(video_id))
+                      for video_id, entry in self.files.items() if entry["state"] == "downloading")
+        return self.used_bytes() + pending
+
+
+    def admit(self, video_id: str, estimated_bytes: int, stop_event: threading.Event = None, block: bool = True) -> bool:
+        # 容量に収まる場合だけダウンロードを許可する (何も管理していない場合は1本だけ許可する)
+        with self._cond:
+            while self.files and self._committed_bytes() + estimated_bytes > self.max_bytes:
+                if not block or (stop_event is not None and stop_event.is_set()):
+                    return False
+                self._cond.wait(5)
+            self.files[video_id] = {"state": "downloading", "reserved": estimated_bytes}
+            return True
+
+
+    def set_state(self, video_id: str, state: str) -> None:
+        with self._cond:
+            if video_id in self.files:
+                self.files[video_id]["state"] = state
+            else:
+                self.files[video_id] = {"state": state, "reserved": 0}
+
+
+    def forget(self, video_id: str) -> None:
+        # ダウンロードに失敗した場合など、ファイルは残したまま管理対象から外す (.part から再開できる)
+        with self._cond:
+            self.files.pop(video_id, None)
+            self._cond.notify_all()
+
+
+    def release(self, video_id: str) -> None:
+        for temp_file in self.video_files(video_id):
+            os.remove(temp_file)
+            print(f"Removed: {temp_file}")
+        with self._cond:
+            self.files.pop(video_id, None)
+            self._cond.notify_all()
+
+
+    def cleanup_orphans(self, keep_ids: set) -> None:
+        # 処理待ちでない動画のファイル (アップロード済み・再試行の上限に達したもの・不明なもの) を削除する
+        # ダウンロード中・アップロード中の動画は残し、それ以外は管理対象からも外す
+        with self._cond:
+            for video_id in [video_id for video_id, entry in self.files.items()
+                             if video_id not in keep_ids and entry["state"] == "ready"]:
+                del self.files[video_id]
+            busy_ids = set(self.files)
+            self._cond.notify_all()
+        for directory in (self.video_dir, self.thumbnail_dir):
+            for entry in os.scandir(directory):
+                video_id = entry.name.split(".")[0]
+                if entry.is_file() and video_id not in keep_ids and video_id not in busy_ids:
+                    os.remove(entry.path)
+                    print(f"Removed orphan: {entry.path}")
@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ThumbnailFetcher:
+    def __init__(self,
+                 cache_dir: str = "data/thumbnail_cache",
+                 max_workers: int = 8):
+        # 取得したサムネイルは内容のハッシュで保存し、ETag / Last-Modified で更新がなければ再取得しない
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max_workers))
+
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.cache_dir, "objects", sha256[:2], sha256)
+
+
+    def fetch(self, url: str, file_name: str, save_index: bool = True) -> str:
+        entry = self.index.get(url)
+        headers = {}
+        if entry is not None and os.path.exists(self._blob_path(entry["sha256"])):
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self.session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304:
+            sha256 = entry["sha256"]
+        else:
+            response.raise_for_status()
+            sha256 = hashlib.sha256(response.content).hexdigest()
+            blob_path = self._blob_path(sha256)
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                temp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(response.content)
+                os.replace(temp_path, blob_path)
+            with self._lock:
+                self.index[url] = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "sha256": sha256
+                }
+
+        self._place(self._blob_path(sha256), file_name, sha256)
+        if save_index:
+            self.save_index()
+        return file_name
+
+
+    def fetch_many(self, items: list[tuple[str, str]]) -> list[str]:
+        # items: (url, 保存先のファイル名) のリスト
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda item: self.fetch(item[0], item[1], save_index=False), items))
+        self.save_index()
+        return results
+
+
+    def _place(self, blob_path: str, file_name: str, sha256: str) -> None:
+        # 保存先に同じ内容のファイルがあれば何もしない
+        if os.path.exists(file_name):
+            if os.path.getsize(file_name) == os.path.getsize(blob_path) and file_sha256(file_name) == sha256:
+                return
+            os.remove(file_name)
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        try:
+            os.link(blob_path, file_name)
+        except OSError:
+            shutil.copyfile(blob_path, file_name)
+
+
+    def save_index(self) -> None:
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{self.index_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.index, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+
+
+def file_sha256(file_name: str) -> str:
+    with open(file_name, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
@@ -1,23 +1,195 @@
+import os
+import copy
+import glob
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpeg
 import yt_dlp
-import urllib.request
 
+from modules.metrics import metrics
+from modules.thumbnail import ThumbnailFetcher
+
+
+class YoutubeDownloader:
+    def __init__(self,
+                 target_dir: str = "temp/videos",
+                 concurrent_fragments: int = 4,
+                 rate_limit: int = None,
+                 throttled_rate: int = None,
+                 http_chunk_size: int = 10 * 1024 * 1024,
+                 retries: int = 10,
+                 parallel_streams: bool = False,
+                 info_max_age: float = 60*10):
+        # YoutubeDL は一度だけ作成して使い回す
+        self.target_dir = target_dir
+        # estimate_size で取得した情報を download で使い回す期限 (秒)
+        # 情報に含まれる署名付きのURLは数時間で切れるので、容量の空き待ちが長引いた場合は取り直す
+        self.info_max_age = info_max_age
+        self.parallel_streams = parallel_streams
+        self.ydl_opts = {
+            'format': 'bestvideo+bestaudio/best',
+            'outtmpl': f'{target_dir}/%(id)s.%(ext)s',
+            'format_sort': ['vcodec:h264','res','acodec:m4a'],
+            # ライブアーカイブ (HLS/DASH) のフラグメントを並列で取得する
+            'concurrent_fragment_downloads': concurrent_fragments,
+            # 中断しても .part ファイルから続きをダウンロードする
+            'continuedl': True,
+            'nopart': False,
+            'retries': retries,
+            'fragment_retries': retries,
+            'http_chunk_size': http_chunk_size,
+            # bytes/sec
+            'ratelimit': rate_limit,
+            # この速度を下回ったら URL を取り直す (bytes/sec)
+            'throttledratelimit': throttled_rate,
+        }
+        self._ydl = yt_dlp.YoutubeDL(self.ydl_opts)
+        self._lock = threading.Lock()
+        self._info = {}
+
+        # 映像・音声を同時にダウンロードするときに使う、ストリームごとの YoutubeDL
+        # フォーマットは呼び出すたびに変わるので、format に渡す関数で slot["format_id"] を選ばせる
+        self._streams = []
+        for _ in range(2):
+            slot = {"format_id": None}
+            opts = dict(self.ydl_opts,
+                        format=lambda ctx, slot=slot: (f for f in ctx["formats"] if f["format_id"] == slot["format_id"]),
+                        outtmpl=f'{target_dir}/%(id)s.f%(format_id)s.%(ext)s')
+            opts.pop("format_sort")
+            self._streams.append((yt_dlp.YoutubeDL(opts), slot, threading.Lock()))
 
-def download_youtube_video(video_id, target_dir):
-    ydl_opts = {
-        'format': 'bestvideo+bestaudio/best',
-        'outtmpl': f'{target_dir}/%(id)s.%(ext)s',
-        'format_sort': ['vcodec:h264','res','acodec:m4a'],
-    }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    def _extract_info(self, video_id: str) -> dict:
+        # estimate_size で取得した情報が新しければ使い回す
+        if video_id in self._info:
+            extracted_at, info = self._info.pop(video_id)
+            if time.monotonic() - extracted_at < self.info_max_age:
+                return info
         url = f'https://www.youtube.com/watch?v={video_id}'
-        ydl.download([url])
-        video_file = f"{target_dir}/{video_id}.mp4"
-        return video_file
+        with self._lock, metrics.timer("api_request_seconds", endpoint="yt-dlp.extract_info"):
+            return self._ydl.extract_info(url, download=False)
+
+
+    def estimate_size(self, video_id: str) -> int:
+        info = self._extract_info(video_id)
+        self._info[video_id] = (time.monotonic(), info)
+        formats = info.get("requested_formats") or [info]
+        return sum(f.get("filesize") or f.get("filesize_approx") or 0 for f in formats)
+
+
+    def clear_info(self, video_id: str) -> None:
+        self._info.pop(video_id, None)
+
+
+    def download(self, video_id: str) -> str:
+        start_time = time.perf_counter()
+        if self.parallel_streams:
+            output_path = self.download_parallel(video_id)
+        else:
+            info = self._extract_info(video_id)
+            with self._lock:
+                info = self._ydl.process_ie_result(info, download=True)
+            output_path = get_output_path(info)
+        metrics.record_stage("download", time.perf_counter() - start_time, os.path.getsize(output_path))
+        return output_path
+
+
+    def download_parallel(self, video_id: str) -> str:
+        # 映像と音声を同時にダウンロードし、再エンコードせずに結合する
+        info = self._extract_info(video_id)
+
+        formats = info.get("requested_formats")
+        if not formats or len(formats) != 2:
+            # 映像と音声が分かれていないフォーマットは通常通りダウンロードする
+            with self._lock:
+                info = self._ydl.process_ie_result(info, download=True)
+            return get_output_path(info)
+
+        output_path = f"{self.target_dir}/{video_id}.{info['ext']}"
+        if os.path.exists(output_path):
+            return output_path
+
+        with ThreadPoolExecutor(max_workers=len(formats)) as executor:
+            stream_paths = list(executor.map(lambda i: self._download_stream(i, info, formats[i]["format_id"]), range(len(formats))))
+
+        video_stream, audio_stream = [ffmpeg.input(path) for path in stream_paths]
+        output_options = {"c": "copy"}
+        if info["ext"] in ("mp4", "m4a", "mov"):
+            # 先頭に moov を置いて、アップロード後すぐに処理が始まるようにする
+            output_options["movflags"] = "+faststart"
+        temp_path = f"{self.target_dir}/{video_id}.temp.{info['ext']}"
+        (
+            ffmpeg
+            .output(video_stream.video, audio_stream.audio, temp_path, **output_options)
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        os.replace(temp_path, output_path)
+
+        for path in stream_paths:
+            os.remove(path)
+        return output_path
+
+
+    def _download_stream(self, index: int, info: dict, format_id: str) -> str:
+        # 取得済みの情報を使い回して、1つのストリームだけをダウンロードする
+        ydl, slot, lock = self._streams[index]
+        with lock:
+            slot["format_id"] = format_id
+            stream_info = ydl.process_ie_result(copy.deepcopy(info), download=True)
+        return get_output_path(stream_info)
+
+
+    def find_file(self, video_id: str) -> str:
+        # ダウンロード済みのファイルを探す (拡張子はフォーマットによって変わる)
+        files = [f for f in glob.glob(f"{self.target_dir}/{glob.escape(video_id)}.*")
+                 if not f.endswith((".part", ".ytdl")) and ".part-Frag" not in f
+                 and not os.path.basename(f).startswith((f"{video_id}.f", f"{video_id}.temp."))]
+        return files[0] if files else None
+
+
+    def close(self):
+        self._ydl.close()
+        for ydl, _, _ in self._streams:
+            ydl.close()
+
+
+def get_output_path(info: dict) -> str:
+    # マージ・後処理が終わった後の実際のファイルパス
+    downloads = info.get("requested_downloads")
+    if downloads:
+        return downloads[0]["filepath"]
+    return info.get("filepath") or info["_filename"]
+
+
+_downloaders = {}
+
+
+def download_youtube_video(video_id, target_dir):
+    if target_dir not in _downloaders:
+        _downloaders[target_dir] = YoutubeDownloader(target_dir)
+    return _downloaders[target_dir].download(video_id)
+
+
+_thumbnail_fetcher = None
+_thumbnail_fetcher_lock = threading.Lock()
+
+
+def get_thumbnail_fetcher() -> ThumbnailFetcher:
+    # 接続とキャッシュを共有するため、プロセス内で1つだけ作成する
+    global _thumbnail_fetcher
+    with _thumbnail_fetcher_lock:
+        if _thumbnail_fetcher is None:
+            _thumbnail_fetcher = ThumbnailFetcher()
+    return _thumbnail_fetcher
 
 
 def download_youtube_thumbnail(video_id, target_dir, url):
     file_name = f'{target_dir}/{video_id}.jpg'
-    print(f"[urllib.request] Downloading thumbnail: {file_name}")
-    urllib.request.urlretrieve(url, file_name)
-    return file_name
\ No newline at end of file
+    print(f"[ThumbnailFetcher] Downloading thumbnail: {file_name}")
+    start_time = time.perf_counter()
+    get_thumbnail_fetcher().fetch(url, file_name)
+    metrics.record_stage("thumbnail", time.perf_counter() - start_time, os.path.getsize(file_name))
+    return file_name
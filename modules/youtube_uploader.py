@@ -4,13 +4,17 @@ import time
 import http.client
 import httplib2
 import ssl
+import math
 import random
-import asyncio
+import hashlib
+import threading
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 
 
 import requests
+import pandas as pd
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv, find_dotenv
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
@@ -18,10 +22,19 @@ from googleapiclient.http import MediaFileUpload
 from googleapiclient.errors import HttpError
 
 from modules.db import DBManager
+from modules.job_queue import WeightedFairQueue, UNFINISHED_LIVE
+from modules.metrics import metrics
+from modules.quota import QuotaLedger
+from modules.snapshot import VideoSnapshot
 
 load_dotenv(find_dotenv())
 
-QUOTA_LIMIT: int = 210000
+# into_str が返す順番
+TARGET_VIDEO_COLUMNS = ["id", "videoType", "title", "description", "publishedAt",
+                        "liveStreamingDetails_scheduledStartTime", "liveStreamingDetails_actualStartTime",
+                        "liveStreamingDetails_actualEndTime", "categoryId", "tags", "thumbnails_url",
+                        "commentCount", "likeCount", "viewCount", "isShorts", "channelId", "channelTitle"]
+STATISTICS_COLUMNS = ["viewCount", "likeCount", "commentCount"]
 
 db = DBManager(
     db_user=os.getenv("DB_USER"),
@@ -36,70 +49,108 @@ scopes = ["https://www.googleapis.com/auth/youtube.upload",
           "https://www.googleapis.com/auth/youtube.force-ssl"]
 
 
-def googleapiclient_login(identity_file: str, port: int = 8080):
+def googleapiclient_login(identity_file: str, port: int = 8080, client_options: dict = None):
     print(f"\nLogin with {identity_file}\nRunning Login on port {port}")
     flow = InstalledAppFlow.from_client_secrets_file(identity_file, scopes)
     credentials = flow.run_local_server(port=port)
-    youtube = build("youtube", "v3", credentials=credentials)
+    youtube = build("youtube", "v3", credentials=credentials, client_options=client_options)
 
     return youtube
 
 
+def googleapiclient_clone(youtube, client_options: dict = None):
+    # 同じ認証情報で別の接続を持つクライアントを作る (クライアントはスレッド間で共有できない)
+    return build("youtube", "v3", credentials=youtube._http.credentials, client_options=client_options)
+
+
 class YoutubeVideoManager:
     def __init__(self,
                  api_key: str,
                  target_channel_id: str,
                  upload_channel_id: str,
-                 max_threads: int = 5):
-
-        self.target_channel_id = target_channel_id
+                 max_threads: int = 5,
+                 refresh_statistics: bool = True,
+                 db_batch_size: int = 500,
+                 quota_block_size: int = 100,
+                 upload_chunk_size: int = 64 * 1024 * 1024,
+                 fetch_threads: int = 4,
+                 api_endpoint: str = None,
+                 youtube_url: str = "https://www.youtube.com",
+                 credentials=None):
+
+        # target_channel_id: カンマ区切りで複数指定できる ("<チャンネルID>:<重み>" で重みを指定)
+        self.channels = parse_channels(target_channel_id)
+        self.target_channel_ids = list(self.channels)
+        self.target_channel_id = self.target_channel_ids[0]
+        self.channel_titles = {}
+        self._legacy_rows_assigned = False
         self.upload_channel_id = upload_channel_id
         self.max_threads = max_threads
-
-        self.youtube_dataSystem = build("youtube", "v3", developerKey=api_key)
-
-        client_data = asyncio.run(db.query("SELECT * FROM QuotaData WHERE name = 'YoutubeArchiver';"))
+        self.refresh_statistics = refresh_statistics
+        self.db_batch_size = db_batch_size
+        self.quota_ledger = QuotaLedger(db, block_size=quota_block_size)
+        self.snapshot = VideoSnapshot(os.path.join("data", "videos.ndjson.gz"))
+        # 256KBの倍数である必要がある
+        self.upload_chunk_size = upload_chunk_size
+
+        self.api_key = api_key
+        self.fetch_threads = fetch_threads
+        self._thread_local = threading.local()
+        # api_endpoint / youtube_url はベンチマーク用のローカルサーバーに向ける場合に指定する
+        self.client_options = {"api_endpoint": api_endpoint} if api_endpoint else None
+        self.youtube_url = youtube_url
+        # 指定した場合はブラウザでのログインを行わずにこの認証情報を使う
+        self.credentials = credentials
+
+        # Shorts判定用のセッション (スレッド間でコネクションを使い回す)
+        self.session = requests.Session()
+        self.session.mount(youtube_url, HTTPAdapter(pool_connections=1, pool_maxsize=max_threads))
+
+        client_data = db.run(db.query("SELECT * FROM QuotaData WHERE name = 'YoutubeArchiver';"))
         if client_data.empty:
             print("** No client data found in the database: YoutubeArchiver **")
             print("**      I will use th first uploader data instead.       **")
-            client_data = asyncio.run(db.query("SELECT * FROM QuotaData LIMIT 1;"))
+            client_data = db.run(db.query("SELECT * FROM QuotaData LIMIT 1;"))
         client_data = client_data.iloc[0]
 
-        self.youtube = googleapiclient_login(client_data["identityFile"], port=8000)
+        if credentials is not None:
+            self.youtube = build("youtube", "v3", credentials=credentials, client_options=self.client_options)
+        else:
+            self.youtube = googleapiclient_login(client_data["identityFile"], port=8000, client_options=self.client_options)
 
         self.uploader = {}
-        uploader_data = asyncio.run(db.query(
+        self._login_lock = threading.Lock()
+        uploader_data = db.run(db.query(
             "SELECT * FROM QuotaData WHERE name LIKE 'default-%' ORDER BY name ASC;"))
         for d in uploader_data.itertuples():
             print(f"Uploaderを読み込みました：{d.name}")
             port = 8000 + int(d.name[-2:]) - 1
             self.uploader[d.name] = (d.identityFile, port)
 
-    async def _quota(self, name: str, value: int):
-        data = (await db.query(
-            f"SELECT quota FROM QuotaData WHERE name = '{name}';"))
-        if data.empty:
-            raise Exception(f"No client data found in the database: {name}")
-        data = data.iloc[0]
-        if not data["quota"] + value < QUOTA_LIMIT:
-            raise Exception(f"Quota exceeded: {name}")
-        await db.query(
-            f"UPDATE QuotaData SET quota = quota + {value} WHERE name = '{name}';")
-        return
-
-    def get_uploads_playlist_id(self):
-        asyncio.run(self._quota("default-01", 1))
-        request = self.youtube_dataSystem.channels().list(
-            part="contentDetails",
-            id=self.target_channel_id,
-            fields="items/contentDetails/relatedPlaylists/uploads"
+    def _quota(self, name: str, value: int):
+        self.quota_ledger.spend(name, value)
+
+    def get_uploads_playlist_id(self, channel_id: str = None):
+        # チャンネル名も同じリクエストで取得しておく (説明文のクレジットに使う)
+        channel_id = channel_id or self.target_channel_id
+        self._quota("default-01", 1)
+        request = self._data_client().channels().list(
+            part="snippet,contentDetails",
+            id=channel_id,
+            fields="items(snippet/title,contentDetails/relatedPlaylists/uploads)"
         )
-        response = request.execute()
-        return response["items"][0]["contentDetails"]["relatedPlaylists"]["uploads"]
+        with metrics.timer("api_request_seconds", endpoint="channels.list"):
+            response = request.execute()
+        item = response["items"][0]
+        title = item.get("snippet", {}).get("title")
+        if title:
+            self.channel_titles[channel_id] = title
+        return item["contentDetails"]["relatedPlaylists"]["uploads"]
 
-    def get_video_id_in_playlist(self, playlistId):
+    def get_video_id_in_playlist(self, playlistId, known_ids: set = None):
         video_id_list = []
-        request = self.youtube_dataSystem.playlistItems().list(
+        youtube = self._data_client()
+        request = youtube.playlistItems().list(
             part="snippet",
             maxResults=50,
             playlistId=playlistId,
@@ -107,44 +158,89 @@ class YoutubeVideoManager:
         )
 
         while request:
-            asyncio.run(self._quota("default-01", 1))
-            response = request.execute()
-            video_id_list.extend(list(
-                map(lambda item: item["snippet"]["resourceId"]["videoId"], response["items"])))
-            request = self.youtube_dataSystem.playlistItems().list_next(request, response)
+            self._quota("default-01", 1)
+            with metrics.timer("api_request_seconds", endpoint="playlistItems.list"):
+                response = request.execute()
+            page_ids = list(
+                map(lambda item: item["snippet"]["resourceId"]["videoId"], response["items"]))
+            video_id_list.extend(page_ids)
+
+            # アップロード再生リストは新しい順なので、既知の動画だけのページに到達したら打ち切る
+            if known_ids and page_ids and all(video_id in known_ids for video_id in page_ids):
+                break
+            request = youtube.playlistItems().list_next(request, response)
 
         return video_id_list
 
+    def _data_client(self):
+        # googleapiclient のクライアントはスレッドセーフではないので、スレッドごとに作成する
+        client = getattr(self._thread_local, "youtube", None)
+        if client is None:
+            client = build("youtube", "v3", developerKey=self.api_key, client_options=self.client_options)
+            self._thread_local.youtube = client
+        return client
+
+    def _get_video_items_chunk(self, chunk):
+        self._quota("default-01", 1)
+        request = self._data_client().videos().list(
+            part="snippet,statistics,liveStreamingDetails",
+            id=",".join(chunk),
+            fields=VIDEO_ITEM_FIELDS
+        )
+        with metrics.timer("api_request_seconds", endpoint="videos.list"):
+            response = request.execute()
+        return response["items"]
+
     def get_video_items(self, video_id_list):
         video_items = []
 
         chunk_list = list(chunks(video_id_list, 50))  # max 50 id per request.
-        for chunk in chunk_list:
-            asyncio.run(self._quota("default-01", 1))
-            video_ids = ",".join(chunk)
-            request = self.youtube_dataSystem.videos().list(
-                part="snippet,statistics,liveStreamingDetails,localizations",
-                id=video_ids
-            )
+        with ThreadPoolExecutor(max_workers=min(self.fetch_threads, len(chunk_list) or 1)) as executor:
+            for items in executor.map(self._get_video_items_chunk, chunk_list):
+                video_items.extend(items)
+
+        return video_items
+
+    def _get_video_statistics_chunk(self, chunk):
+        self._quota("default-01", 1)
+        request = self._data_client().videos().list(
+            part="statistics",
+            id=",".join(chunk),
+            fields="items(id,statistics)"
+        )
+        with metrics.timer("api_request_seconds", endpoint="videos.list"):
             response = request.execute()
-            video_items.extend(response["items"])
+        return response["items"]
+
+    def get_video_statistics(self, video_id_list):
+        video_items = []
+
+        chunk_list = list(chunks(video_id_list, 50))  # max 50 id per request.
+        with ThreadPoolExecutor(max_workers=min(self.fetch_threads, len(chunk_list) or 1)) as executor:
+            for items in executor.map(self._get_video_statistics_chunk, chunk_list):
+                video_items.extend(items)
 
         return video_items
 
     def is_youtube_shorts(self, videoId):
-        shorts_url = f"https://www.youtube.com/shorts/{videoId}"
-        response = requests.get(shorts_url, allow_redirects=True)
+        # Shortsは200、通常動画は watch?v= へのリダイレクトが返るので本文は取得しない
+        shorts_url = f"{self.youtube_url}/shorts/{videoId}"
+        with metrics.timer("api_request_seconds", endpoint="shorts.head"):
+            response = self.session.head(shorts_url, allow_redirects=False, timeout=10)
+        response.close()
 
-        if response.url == shorts_url:
+        if response.status_code == 200:
             return True
-        elif "watch?v=" in response.url:
+        elif response.is_redirect and "watch?v=" in response.headers.get("Location", ""):
             return False
         else:
             return None
 
 
     def get_video_type(self, video_items):
-        start_time = time.time()
+        # 判定済みの動画はスキップする
+        video_items = [video for video in video_items if video.get("isShorts") is None]
+        start_time = end_time = time.time()
         total = len(video_items)
 
         with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
@@ -155,6 +251,7 @@ class YoutubeVideoManager:
                 try:
                     video["isShorts"] = future.result()
                 except Exception as exc:
+                    video["isShorts"] = None
                     print(f"{video['id']} generated an exception: {exc}")
                 end_time = time.time()
                 print(
@@ -163,71 +260,203 @@ class YoutubeVideoManager:
         print(f"\r動画タイプを取得しました  time: {int(end_time - start_time)} sec")
 
 
-    def save_video_data(self):
-        uploads_playlist_id = self.get_uploads_playlist_id()
-        video_id_list = self.get_video_id_in_playlist(uploads_playlist_id)
-        print(f"動画IDを取得しました：{len(video_id_list)}本")
-        video_items = self.get_video_items(video_id_list)
-        print(f"動画データを取得しました：{len(video_items)}本")
-        self.get_video_type(video_items)
-        json_save(video_items, os.path.join("data", "videos.json"))
-        asyncio.run(self._save_database(video_items))
+    def save_video_data(self, full_sync: bool = False, refresh_statistics: bool = None):
+        if refresh_statistics is None:
+            refresh_statistics = self.refresh_statistics
+
+        known_ids = set()
+        if not full_sync:
+            known_ids = set(db.run(db.query("SELECT id FROM TargetVideo;"))["id"])
+
+        # チャンネルごとの取得は並行して行い、書き込みはまとめて1回にする
+        video_items = []
+        with ThreadPoolExecutor(max_workers=len(self.target_channel_ids)) as executor:
+            for items in executor.map(lambda channel_id: self._fetch_channel(channel_id, known_ids), self.target_channel_ids):
+                video_items.extend(items)
+        new_count = len(video_items)
+        self._assign_legacy_rows()
+
+        # 配信予定・配信中として保存した動画は、終了日時が記録されるまで毎回取得し直す
+        live_items = []
+        if not full_sync:
+            live_items = self.get_video_items(self._unfinished_live_ids())
+            if live_items:
+                print(f"配信予定・配信中の動画を取得し直しました：{len(live_items)}本")
+            video_items.extend(live_items)
+
+        if video_items:
+            if full_sync or len(video_items) > new_count:
+                self.apply_cached_video_type(video_items)
+            with metrics.timer("stage_duration_seconds", stage="sync_video_type"):
+                self.get_video_type(video_items)
+            with metrics.timer("stage_duration_seconds", stage="sync_save"):
+                self.snapshot.write(video_items)
+                db.run(self._save_database(video_items))
+
+        self.resolve_unknown_video_type({video["id"] for video in video_items})
+
+        # 取得し直した配信の統計情報は上で保存済み
+        statistics_ids = known_ids - {video["id"] for video in live_items}
+        if refresh_statistics and statistics_ids:
+            with metrics.timer("stage_duration_seconds", stage="sync_statistics"):
+                statistics_items = self.get_video_statistics(list(statistics_ids))
+                changed = db.run(self._save_statistics(statistics_items))
+            print(f"統計情報を更新しました：{changed}本 (変更なし: {len(statistics_items) - changed}本)")
+        for channel_id in self.target_channel_ids:
+            metrics.inc("sync_videos_total", len([video for video in video_items[:new_count] if video["snippet"]["channelId"] == channel_id]),
+                        kind="new", channel=channel_id)
+
+
+    def _unfinished_live_ids(self) -> list[str]:
+        data = db.run(db.query(f"SELECT id FROM TargetVideo WHERE isPushed = 0 AND {UNFINISHED_LIVE};"))
+        return list(data["id"]) if not data.empty else []
+
+
+    def _fetch_channel(self, channel_id: str, known_ids: set) -> list:
+        with metrics.timer("stage_duration_seconds", stage="sync_playlist", channel=channel_id):
+            uploads_playlist_id = self.get_uploads_playlist_id(channel_id)
+            video_id_list = self.get_video_id_in_playlist(uploads_playlist_id, known_ids)
+        new_video_id_list = [video_id for video_id in video_id_list if video_id not in known_ids]
+        channel_title = self.channel_titles.get(channel_id, channel_id)
+        print(f"[{channel_title}] 動画IDを取得しました：{len(video_id_list)}本 (新規: {len(new_video_id_list)}本)")
+
+        with metrics.timer("stage_duration_seconds", stage="sync_video_items", channel=channel_id):
+            video_items = self.get_video_items(new_video_id_list)
+        print(f"[{channel_title}] 動画データを取得しました：{len(video_items)}本")
+        return video_items
+
+
+    def _assign_legacy_rows(self):
+        # チャンネルIDを保存する前に追加された動画は、最初に指定したチャンネルのものとして扱う
+        # 移行時だけ必要なので、起動後の最初の同期で1回だけ行う (チャンネル名はその同期で取得したもの)
+        if self._legacy_rows_assigned:
+            return
+        self._legacy_rows_assigned = True
+        db.run(db.query(
+            "UPDATE TargetVideo SET channelId = :channelId, channelTitle = :channelTitle WHERE channelId IS NULL;",
+            {"channelId": self.target_channel_id, "channelTitle": self.channel_titles.get(self.target_channel_id)}))
 
 
     async def _save_database(self, json_data):
-        chunks_data = list(chunks(json_data, 30))
-        for chunk in chunks_data:
-            rows = []
-            for video in chunk:
-                columns = into_str(video)
-                rows.append(str(tuple(columns)).replace("None", "NULL"))
-
-            query = f"""
-                INSERT INTO TargetVideo
-                    (id, videoType, title, description, publishedAt,
-                    liveStreamingDetails_scheduledStartTime, liveStreamingDetails_actualStartTime,
-                    liveStreamingDetails_actualEndTime, categoryId, tags, thumbnails_url,
-                    commentCount, likeCount, viewCount)
-                VALUES
-                    {",".join(rows)}
-                ON DUPLICATE KEY
-                UPDATE
-                    videoType = VALUES(videoType),
-                    title = VALUES(title),
-                    description = VALUES(description),
-                    publishedAt = VALUES(publishedAt),
-                    liveStreamingDetails_scheduledStartTime = VALUES(liveStreamingDetails_scheduledStartTime),
-                    liveStreamingDetails_actualStartTime = VALUES(liveStreamingDetails_actualStartTime),
-                    liveStreamingDetails_actualEndTime = VALUES(liveStreamingDetails_actualEndTime),
-                    categoryId = VALUES(categoryId),
-                    tags = VALUES(tags),
-                    thumbnails_url = VALUES(thumbnails_url),
-                    commentCount = VALUES(commentCount),
-                    likeCount = VALUES(likeCount),
-                    viewCount = VALUES(viewCount);
-                """
-
-            await db.query(query.replace("Ninomae Ina'nis", "Ninomae Ina’nis"))
-
-
-    async def _select_uploader(self, value: int):
+        # 統計情報は書き込む前の値と比べて履歴に残すので、先に読み込んでおく
+        current = await self._current_statistics([video["id"] for video in json_data])
+
+        rows = []
+        for video in json_data:
+            row = dict(zip(TARGET_VIDEO_COLUMNS, into_str(video)))
+            row["contentHash"] = content_hash(row)
+            rows.append(row)
+        result = await db.bulk_upsert(
+            "TargetVideo",
+            TARGET_VIDEO_COLUMNS + ["contentHash"],
+            rows,
+            update_expressions={"isShorts": "COALESCE(VALUES(isShorts), isShorts)"},
+            batch_size=self.db_batch_size,
+            hash_column="contentHash"
+        )
+        print(f"データベースを更新しました：追加 {result['inserted']}本 / 更新 {result['updated']}本 / 変更なし {result['unchanged']}本")
+
+        # 動画の情報が変わっていない行は書き込まれないので、統計情報だけ別に更新する
+        await self._save_statistics(json_data, current)
+        return result
+
+
+    def apply_cached_video_type(self, video_items):
+        cached = db.run(db.query("SELECT id, isShorts FROM TargetVideo WHERE isShorts IS NOT NULL;"))
+        cached = dict(zip(cached["id"], cached["isShorts"]))
+        for video in video_items:
+            if video["id"] in cached:
+                video["isShorts"] = bool(cached[video["id"]])
+
+
+    def resolve_unknown_video_type(self, exclude_ids: set = set()):
+        # 前回までに判定できなかった動画だけを再判定する
+        unknown = db.run(db.query("SELECT id FROM TargetVideo WHERE isShorts IS NULL;"))
+        video_items = [{"id": video_id} for video_id in unknown["id"] if video_id not in exclude_ids]
+        if not video_items:
+            return
+
+        self.get_video_type(video_items)
+        shorts_ids = [video["id"] for video in video_items if video["isShorts"] is True]
+        not_shorts_ids = [video["id"] for video in video_items if video["isShorts"] is False]
+        if shorts_ids:
+            db.run(db.query(
+                "UPDATE TargetVideo SET isShorts = 1, videoType = 'shorts' WHERE id IN :ids;",
+                {"ids": shorts_ids}, expanding=["ids"]))
+        if not_shorts_ids:
+            db.run(db.query(
+                "UPDATE TargetVideo SET isShorts = 0 WHERE id IN :ids;",
+                {"ids": not_shorts_ids}, expanding=["ids"]))
+
+
+    async def _current_statistics(self, video_ids: list[str]) -> dict:
+        # 動画ID -> (viewCount, likeCount, commentCount)
+        current = {}
+        for chunk in chunks(video_ids, 1000):
+            data = await db.query(
+                f"SELECT id, {', '.join(STATISTICS_COLUMNS)} FROM TargetVideo WHERE id IN :ids;",
+                {"ids": chunk}, expanding=["ids"])
+            for row in data.itertuples(index=False):
+                current[row[0]] = tuple(None if pd.isna(value) else int(value) for value in row[1:])
+        return current
+
+
+    async def _save_statistics(self, statistics_items, current: dict = None) -> int:
+        # 前回から変わった動画だけを更新し、変化を VideoStatisticsHistory に追記する
+        if current is None:
+            current = await self._current_statistics([video["id"] for video in statistics_items])
+        changed = [video for video in statistics_items if statistics_of(video) != current.get(video["id"])]
+        if not changed:
+            return 0
+
+        recorded_at = datetime.now().replace(microsecond=0)
+        # 同じ秒に他のワーカーも同期した場合は同じキーになるので、上書きする
+        await db.bulk_insert(
+            "VideoStatisticsHistory",
+            ["videoId", "recordedAt"] + STATISTICS_COLUMNS,
+            [dict(zip(["videoId", "recordedAt"] + STATISTICS_COLUMNS, (video["id"], recorded_at) + statistics_of(video)))
+             for video in changed],
+            key_columns=["videoId", "recordedAt"]
+        )
+
+        # 新しく追加した動画は upsert で書き込み済み (変わった動画だけを1つのトランザクションで更新する)
+        rows = [dict(zip(["id"] + STATISTICS_COLUMNS, (video["id"],) + statistics_of(video)))
+                for video in changed if video["id"] in current]
+        if rows:
+            await db.query("""
+                UPDATE TargetVideo
+                SET commentCount = :commentCount, likeCount = :likeCount, viewCount = :viewCount
+                WHERE id = :id;
+                """, rows)
+        return len(changed)
+
+
+    def _select_uploader(self, value: int, block: bool = True):
+        # block=False の場合は、どのアップローダーにもクォータが残っていなければ None を返す
         while True:
-            uploader_data = (await db.query(
-                f"SELECT * FROM QuotaData WHERE name LIKE 'default-%' AND {QUOTA_LIMIT} > quota + {value} ORDER BY name ASC LIMIT 1;"))
-            print(uploader_data)
-            if uploader_data.empty:
-                print(f"\rNo uploader available. Waiting for 15 minutes.  {datetime.now()}", end="")
-                time.sleep(60*15)
-            else:
-                uploader_data = uploader_data.iloc[0]
-                await db.query(
-                    f"UPDATE QuotaData SET quota = quota + {value} WHERE name = '{uploader_data['name']}';")
-                break
+            for name in sorted(self.uploader):
+                if self.quota_ledger.try_spend(name, value):
+                    return name
+            if not block:
+                return None
+            self.quota_ledger.wait_for_quota()
+
+
+    def _get_uploader(self, name: str):
+        # ログインはブラウザ操作を待つので、DBのイベントループの外で行う
+        # 同時に複数の同意画面を開かないように1つずつ行う
+        with self._login_lock:
+            if type(self.uploader[name]) == tuple:
+                if self.credentials is not None:
+                    self.uploader[name] = build("youtube", "v3", credentials=self.credentials, client_options=self.client_options)
+                else:
+                    self.uploader[name] = googleapiclient_login(self.uploader[name][0], self.uploader[name][1], self.client_options)
+
+        return self.uploader[name]
 
-        if type(self.uploader[uploader_data["name"]]) == tuple:
-            self.uploader[uploader_data["name"]] = googleapiclient_login(self.uploader[uploader_data["name"]][0], self.uploader[uploader_data["name"]][1])
 
-        return self.uploader[uploader_data["name"]]
+    def start_dispatcher(self, max_concurrency: int = 2, quota_cost: int = 1600) -> "UploadDispatcher":
+        return UploadDispatcher(self, max_concurrency=max_concurrency, quota_cost=quota_cost, channel_weights=self.channels)
 
 
     def upload_video(self,
@@ -236,11 +465,39 @@ class YoutubeVideoManager:
                      description: str,
                      category_id: str,
                      thumbnail_file_path: str = None,
-                     tags: list[str] = []):
-
-        yt_uploader = asyncio.run(self._select_uploader(1600))
+                     tags: list[str] = [],
+                     uploader_name: str = None,
+                     video_id: str = None):
+
+        reserved_uploader = uploader_name
+
+        # 前回の処理でアップロードまで終わっている動画は送り直さない (重複してアップロードされるため)
+        upload_video_id = db.run(self._load_upload_video_id(video_id)) if video_id else None
+        if upload_video_id is not None:
+            if reserved_uploader is not None:
+                self.quota_ledger.refund(reserved_uploader, 1600)
+            print(f"Already uploaded as {upload_video_id}: {video_file_path}")
+            return {"id": upload_video_id}
+
+        # 前回中断したアップロードがあれば、同じアカウント・同じセッションで続きから送る
+        session = db.run(self._load_upload_session(video_id, video_file_path)) if video_id else None
+
+        # uploader_name を指定した場合は、呼び出し側でクォータを確保済みとする
+        if session is not None:
+            if reserved_uploader is not None:
+                # 再開時はクォータを消費しないので確保した分を戻す
+                self.quota_ledger.refund(reserved_uploader, 1600)
+            uploader_name = session["uploaderName"]
+            yt_uploader = self._get_uploader(uploader_name)
+            if reserved_uploader is not None and reserved_uploader != uploader_name:
+                yt_uploader = googleapiclient_clone(yt_uploader, self.client_options)
+            print(f"Resume upload from {int(session['progress'])} bytes: {video_file_path}")
+        else:
+            if uploader_name is None:
+                uploader_name = self._select_uploader(1600)
+            yt_uploader = self._get_uploader(uploader_name)
 
-        media = MediaFileUpload(video_file_path, resumable=True)
+        media = MediaFileUpload(video_file_path, chunksize=self.upload_chunk_size, resumable=True)
         request = yt_uploader.videos().insert(
             part="snippet,status",
             body={
@@ -265,25 +522,131 @@ class YoutubeVideoManager:
 
         )
 
-        response = resumable_upload(request)
+        if session is not None:
+            request.resumable_uri = session["sessionUri"]
+            request.resumable_progress = int(session["progress"])
+            # 最初の next_chunk でサーバーが受信済みのバイト数を問い合わせる
+            request._in_error_state = True
+
+        def save_progress(request):
+            if video_id:
+                db.run(self._save_upload_session(video_id, uploader_name, video_file_path, request))
+
+        start_progress = request.resumable_progress if session is not None else 0
+        start_time = time.perf_counter()
+        try:
+            response = resumable_upload(request, on_progress=save_progress)
+        except HttpError as e:
+            if session is None or e.resp.status not in [404, 410]:
+                raise
+            # セッションの有効期限切れ。最初からアップロードし直す
+            print(f"Upload session expired: {video_file_path}")
+            db.run(self._delete_upload_session(video_id))
+            if reserved_uploader is not None:
+                self.quota_ledger.spend(reserved_uploader, 1600)
+            return self.upload_video(video_file_path, title, description, category_id,
+                                     thumbnail_file_path, tags, reserved_uploader, video_id)
+
+        metrics.record_stage("upload", time.perf_counter() - start_time,
+                             os.path.getsize(video_file_path) - start_progress, identity=uploader_name)
+
+        if video_id:
+            # この後のサムネイルの設定などに失敗しても送り直さないように、すぐにアップロード済みにする
+            # (ここで失敗した場合はセッションが残るので、次回は完了済みのセッションから結果を受け取る)
+            db.run(self._save_uploaded(video_id, response["id"], bool(thumbnail_file_path)))
+            db.run(self._delete_upload_session(video_id))
 
         if thumbnail_file_path:
-            self.upload_thumbnail(response["id"], thumbnail_file_path)
+            # 動画はアップロード済みなので失敗扱いにせず、サムネイルだけを後で設定し直す
+            try:
+                if not self.quota_ledger.try_spend(uploader_name, 50):
+                    raise Exception(f"Quota exceeded: {uploader_name}")
+                self.upload_thumbnail(response["id"], thumbnail_file_path, uploader_name, yt_uploader)
+            except Exception as e:
+                print(f"Failed to set the thumbnail: {e}")
+            else:
+                if video_id:
+                    db.run(db.query(
+                        "UPDATE TargetVideo SET isThumbnailPending = 0 WHERE id = :id;", {"id": video_id}))
 
         return response
 
 
+    async def _load_upload_video_id(self, video_id: str):
+        data = await db.query("SELECT uploadVideoId FROM TargetVideo WHERE id = :id;", {"id": video_id})
+        if data.empty or pd.isna(data.iloc[0]["uploadVideoId"]):
+            return None
+        return data.iloc[0]["uploadVideoId"]
+
+
+    async def _save_uploaded(self, video_id: str, upload_video_id: str, thumbnail_pending: bool):
+        # 失敗回数はサムネイルの再設定の回数として数え直す
+        await db.query("""
+            UPDATE TargetVideo
+            SET isPushed = 1, uploadVideoId = :uploadVideoId, isThumbnailPending = :thumbnailPending,
+                failedAttempts = 0, nextAttemptAt = NULL
+            WHERE id = :id;
+            """, {"id": video_id, "uploadVideoId": upload_video_id, "thumbnailPending": int(thumbnail_pending)})
+
+
+    async def _load_upload_session(self, video_id: str, video_file_path: str):
+        data = await db.query(
+            "SELECT * FROM UploadSession WHERE videoId = :videoId;", {"videoId": video_id})
+        if data.empty:
+            return None
+        data = data.iloc[0]
+        if data["fileSize"] != os.path.getsize(video_file_path):
+            # 別のファイルに差し替わっている場合は最初から送る
+            await self._delete_upload_session(video_id)
+            return None
+        return data
+
+
+    async def _save_upload_session(self, video_id: str, uploader_name: str, video_file_path: str, request):
+        await db.query("""
+            INSERT INTO UploadSession (videoId, uploaderName, sessionUri, progress, fileSize)
+            VALUES (:videoId, :uploaderName, :sessionUri, :progress, :fileSize)
+            ON DUPLICATE KEY UPDATE
+                uploaderName = VALUES(uploaderName),
+                sessionUri = VALUES(sessionUri),
+                progress = VALUES(progress),
+                fileSize = VALUES(fileSize);
+            """, {
+                "videoId": video_id,
+                "uploaderName": uploader_name,
+                "sessionUri": request.resumable_uri,
+                "progress": request.resumable_progress,
+                "fileSize": os.path.getsize(video_file_path)
+            })
+
+
+    async def _delete_upload_session(self, video_id: str):
+        await db.query("DELETE FROM UploadSession WHERE videoId = :videoId;", {"videoId": video_id})
+
+
     def upload_thumbnail(self,
                          video_id: str,
-                         thumbnail_file_path: str):
-        asyncio.run(self._quota("default-01", 50))
+                         thumbnail_file_path: str,
+                         uploader_name: str = None,
+                         client=None):
+        # クォータは実際にリクエストを送るアップローダーから消費する
+        # uploader_name を指定した場合は、呼び出し側でクォータを確保済みとする
+        # (指定しない場合、どのアップローダーにもクォータが残っていなければ待たずに None を返す)
+        # client: 呼び出し側のスレッドで使っているクライアント (アップロードに使ったものをそのまま使う)
+        if uploader_name is None:
+            uploader_name = self._select_uploader(50, block=False)
+            if uploader_name is None:
+                return None
+        if client is None:
+            client = self._get_uploader(uploader_name)
         media = MediaFileUpload(thumbnail_file_path,
                                 chunksize=-1, resumable=True)
-        request = self.youtube.thumbnails().set(
+        request = client.thumbnails().set(
             media_body=media,
             videoId=video_id
         )
-        response = resumable_upload(request)
+        with metrics.timer("api_request_seconds", endpoint="thumbnails.set"):
+            response = resumable_upload(request)
 
         return response
 
@@ -293,9 +656,13 @@ class YoutubeVideoManager:
                    title: str,
                    description: str,
                    category_id: str,
-                   tags: list[str] = []):
-        asyncio.run(self._quota("default-01", 50))
-        request = self.youtube_dataSystem.videos().update(
+                   tags: list[str] = [],
+                   uploader_name: str = None):
+        # 更新にはアップロード先チャンネルの認証が必要なので、アップローダーのクライアントを使う
+        # uploader_name を指定した場合は、呼び出し側でクォータを確保済みとする
+        if uploader_name is None:
+            uploader_name = self._select_uploader(50)
+        request = self._get_uploader(uploader_name).videos().update(
             part="id,snippet",
             body={
                 "id": video_id,
@@ -310,12 +677,84 @@ class YoutubeVideoManager:
                 }
             }
         )
-        response = request.execute()
+        with metrics.timer("api_request_seconds", endpoint="videos.update"):
+            response = request.execute()
 
         return response
 
 
 
+class UploadDispatcher:
+    def __init__(self,
+                 manager: YoutubeVideoManager,
+                 max_concurrency: int = 2,
+                 quota_cost: int = 1600,
+                 channel_weights: dict = None):
+        # アップローダー(identity)ごとにワーカーを1つ立て、クォータが残っているものから並行してアップロードする
+        # 待っているジョブはチャンネルごとに分け、重みに応じた割合でアップローダーに割り当てる
+        # ワーカーがいないと submit したジョブが永遠に終わらないので、ここで止める
+        if not manager.uploader:
+            raise Exception("Error: No uploader is registered. Add 'default-XX' rows to QuotaData.")
+        self.manager = manager
+        self.quota_cost = quota_cost
+        self.jobs = WeightedFairQueue(channel_weights)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self._stopped = threading.Event()
+        self.workers = []
+        for name in manager.uploader:
+            worker = threading.Thread(target=self._worker, args=(name,), name=f"uploader-{name}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def submit(self, job, channel_id: str = None) -> Future:
+        # job はアップローダー名を受け取って実際のアップロードを行う関数
+        future = Future()
+        self.jobs.put((job, future, channel_id), channel_id)
+        return future
+
+
+    def shutdown(self):
+        # クォータ待ちのワーカーも起こして終了させる (デーモンモードでは処理のたびに作り直すため)
+        # 実行中のジョブは終わるまで待ち、まだ始まっていないジョブはキャンセルする
+        self._stopped.set()
+        self.jobs.close()
+        self.manager.quota_ledger.wake_all()
+        for worker in self.workers:
+            worker.join()
+        while (item := self.jobs.get()) is not None:
+            item[1].cancel()
+
+
+    def _worker(self, name: str):
+        while not self._stopped.is_set():
+            if not db.run(self.manager.quota_ledger.has_quota(name, self.quota_cost)):
+                self.manager.quota_ledger.wait_for_quota(name, self._stopped)
+                continue
+
+            item = self.jobs.get()
+            if item is None:
+                return
+            job, future, channel_id = item
+            if self._stopped.is_set():
+                future.cancel()
+                return
+
+            with self.slots:
+                if not self.manager.quota_ledger.try_spend(name, self.quota_cost):
+                    # 他のワーカーに先に使われた場合は別のアップローダーに回す
+                    self.jobs.put(item, channel_id, front=True)
+                    continue
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = job(name)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+
 httplib2.RETRIES = 1
 MAX_RETRIES = 10
 RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error,
@@ -331,12 +770,11 @@ RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error,
 RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
 
 
-def resumable_upload(insert_request):
+def resumable_upload(insert_request, on_progress=None):
     startTime = time.time()
     response = None
     error = None
     retry = 0
-    previous_progress = 0
     print("Uploading file...")
     while response is None:
         try:
@@ -344,6 +782,9 @@ def resumable_upload(insert_request):
             if status:
                 print(
                     f"\rUpload {int(status.progress() * 100)}% complete.   Time: {time.time()-startTime:.2f}", end="")
+                if on_progress is not None:
+                    on_progress(insert_request)
+                retry = 0
 
             if response is not None:
                 if 'id' in response:
@@ -363,7 +804,8 @@ def resumable_upload(insert_request):
             print(error)
             retry += 1
             if retry > MAX_RETRIES:
-                exit("No longer attempting to retry.")
+                # セッションは保存済みなので、次回の実行時に続きから再開できる
+                raise Exception("No longer attempting to retry.")
             max_sleep = 2 ** retry
             sleep_seconds = random.random() * max_sleep
             print("Sleeping %f seconds and then retrying..." % sleep_seconds)
@@ -373,17 +815,16 @@ def resumable_upload(insert_request):
     return response
 
 
-def json_save(data, filename):
-    if not os.path.exists(os.path.dirname(filename)):
-        os.makedirs(os.path.dirname(filename))
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, sort_keys=True, indent=4, ensure_ascii=False)
-
-
-def load_json(filename):
-    with open(filename, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    return data
+# into_str で使う項目だけを取得する
+VIDEO_ITEM_FIELDS = (
+    "items("
+    "id,"
+    "snippet(title,description,publishedAt,channelId,channelTitle,categoryId,tags,"
+    "thumbnails(maxres/url,standard/url,high/url,medium/url,default/url)),"
+    "statistics(commentCount,likeCount,viewCount),"
+    "liveStreamingDetails(scheduledStartTime,actualStartTime,actualEndTime)"
+    ")"
+)
 
 
 def chunks(lst, n):
@@ -391,11 +832,49 @@ def chunks(lst, n):
         yield lst[i:i + n]
 
 
+def parse_channels(value: str) -> dict:
+    # "UCxxxx:2,UCyyyy" -> {"UCxxxx": 2.0, "UCyyyy": 1.0}
+    channels = {}
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        channel_id, _, weight = entry.partition(":")
+        channel_id = channel_id.strip()
+        if not weight:
+            channels[channel_id] = 1.0
+            continue
+        try:
+            weight = float(weight)
+        except ValueError:
+            raise ValueError(f"Error: TARGET_YOUTUBE_CHANNEL_ID has an invalid weight: {entry}")
+        # 0 や負の重みは他のチャンネルを止めてしまうので受け付けない
+        if not math.isfinite(weight) or weight <= 0:
+            raise ValueError(f"Error: TARGET_YOUTUBE_CHANNEL_ID weight must be a positive number: {entry}")
+        channels[channel_id] = weight
+    if not channels:
+        raise ValueError("Error: TARGET_YOUTUBE_CHANNEL_ID is empty.")
+    return channels
+
+
+def statistics_of(video) -> tuple:
+    # statistics が返されない・非公開の項目は None (DB の NULL と同じ扱い)
+    statistics = video.get("statistics") or {}
+    return tuple(None if statistics.get(key) is None else int(statistics[key]) for key in STATISTICS_COLUMNS)
+
+
+def content_hash(row: dict) -> str:
+    # 統計情報以外のカラムのハッシュ (統計情報は VideoStatisticsHistory で別に管理する)
+    values = [row[column] for column in TARGET_VIDEO_COLUMNS if column not in STATISTICS_COLUMNS]
+    return hashlib.sha256(json.dumps(values, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
 def into_str(video):
     columns = []
     columns.append(video["id"])
 
-    if video["isShorts"]:
+    is_shorts = video.get("isShorts")
+    if is_shorts:
         columns.append("shorts")
     elif "liveStreamingDetails" in video:
         # ライブ配信アーカイブまたはプレミア公開
@@ -423,8 +902,8 @@ def into_str(video):
 
     columns.append(video["snippet"]["categoryId"]
                    if "categoryId" in video["snippet"] else None)
-    columns.append("[" + ",".join([f"'{tag}'" for tag in video["snippet"]
-                   ["tags"]]) + "]" if "tags" in video["snippet"] else None)
+    columns.append(json.dumps(video["snippet"]["tags"], ensure_ascii=False)
+                   if "tags" in video["snippet"] else None)
 
     thumbnails = video["snippet"]["thumbnails"]
     if "maxres" in thumbnails:
@@ -438,9 +917,11 @@ def into_str(video):
     else:
         columns.append(thumbnails["default"]["url"])
 
-    columns.append(video["statistics"]["commentCount"]
-                   if "commentCount" in video["statistics"] else None)
-    columns.append(video["statistics"]["likeCount"]
-                   if "likeCount" in video["statistics"] else None)
-    columns.append(video["statistics"]["viewCount"])
+    statistics = video.get("statistics") or {}
+    columns.append(statistics.get("commentCount"))
+    columns.append(statistics.get("likeCount"))
+    columns.append(statistics.get("viewCount"))
+    columns.append(None if is_shorts is None else int(is_shorts))
+    columns.append(video["snippet"]["channelId"])
+    columns.append(video["snippet"]["channelTitle"])
     return columns